@@ -0,0 +1,229 @@
+"""Persistent ald-admin session driver.
+
+AldAdminSession keeps one interactive 'ald-admin cmd' session open
+and runs many user-add/group-add commands in it. Every interactive
+command is described by a Dialog: the list of prompt patterns and
+replies, compiled once. By default prompts are answered in whatever
+order they come until the command prompt returns, which is fast for
+bulk seeding. Tests of the dialog itself run commands in ordered mode
+where every prompt must come in dialog order and none may be missed;
+only optional prompts (e.g. admin password asked once per session)
+may be skipped.
+"""
+
+import re
+import pexpect
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+class DialogError(Exception):
+    """Prompts of ordered dialog came out of order or were missed."""
+    pass
+
+
+class Dialog:
+    """Compiled dialog script of interactive ald-admin command.
+
+    steps is the list of (pattern, reply) pairs. A pattern may
+    contain '%s' which is replaced with escaped object name. A reply
+    is format string with fields: name, value (password of user or
+    description of group) and admin. If optional is True then the
+    prompts may be skipped in ordered mode.
+    """
+    def __init__(self, steps, optional=False):
+        self.steps = list(steps)
+        self.optional = [optional] * len(self.steps)
+        self._compiled = [None if '%s' in pattern else re.compile(pattern)
+                          for pattern, reply in self.steps]
+
+    def __add__(self, other):
+        dialog = Dialog(self.steps + other.steps)
+        dialog.optional = self.optional + other.optional
+        return dialog
+
+    def allowed(self, position):
+        """Return indices of prompts which may come at position."""
+        indices = []
+        for index in range(position, len(self.steps)):
+            indices.append(index)
+            if not self.optional[index]:
+                break
+        return indices
+
+    def missing(self, position):
+        """Return patterns of required prompts from position on."""
+        return [self.steps[index][0]
+                for index in range(position, len(self.steps))
+                if not self.optional[index]]
+
+    def patterns(self, name=''):
+        """Return the list of compiled patterns for name."""
+        return [compiled or re.compile(pattern % re.escape(name))
+                for compiled, (pattern, reply)
+                in zip(self._compiled, self.steps)]
+
+    def reply(self, index, **values):
+        """Return reply to prompt matched by patterns()[index]."""
+        return self.steps[index][1].format(**values)
+
+
+# Admin password is asked only once per session.
+ADMIN_DIALOG = Dialog([
+    (r"Введите пароль администратора ALD:", '{admin}')
+], optional=True)
+
+# Create user with all default settings.
+USER_ADD_DIALOG = ADMIN_DIALOG + Dialog([
+    (r"Введите новый пароль для пользователя '%s':", '{value}'),
+    (r"Повторите пароль:", '{value}'),
+    (r"Введите идентификатор пользователя \(UID\) \[[0-9]+\]:", ''),
+    (r"Создать новую первичную группу .* \[yes\]:", ''),
+    (r"Введите имя новой первичной .* \[%s\]:", ''),
+    (r"Введите идентификатор группы \(GID\) \[[0-9]+\]:", ''),
+    (r"Введите описание группы .*:", ''),
+    (r"Введите командную оболочку .* \[/bin/bash\]:", ''),
+    (r"Введите тип ФС .* local, nfs, cifs\):", ''),
+    (r"Введите сервер домашнего каталога .*:", ''),
+    (r"Введите домашний .*\[/ald_home/%s\]: ", ''),
+    (r"Введите полное имя пользователя \[%s\]:", ''),
+    (r"Введите параметр GECOS .*\[%s,,,\]:", ''),
+    (r"Введите описание пользователя:", ''),
+    (r"Введите политику пароля для пользователя \[default\]:", ''),
+    (r"Установить флаг .*\(yes/no\) \[no\]:", ''),
+    (r"Всё правильно\? \(yes/no\) \[no\]:", 'y')
+])
+
+# Create group with default GID.
+GROUP_ADD_DIALOG = ADMIN_DIALOG + Dialog([
+    (r"Введите идентификатор группы \(GID\) \[[0-9]+\]:", ''),
+    (r"Введите описание группы .*:", '{value}'),
+    (r"Всё правильно\? \(yes/no\) \[no\]:", 'y')
+])
+
+
+class AldAdminSession:
+    """One interactive ald-admin session for many commands.
+
+    Constructor requires ALD admin/admin password. Optional command
+    is the program to spawn (a stand-in may be used for testing).
+    Optional delay is pexpect delaybeforesend. Replies are sent only
+    after the prompt is seen, so no delay is needed by default.
+    Use as context manager or call close() at the end.
+    """
+    PROMPT = re.compile('>( |\t)')
+
+    def __init__(self, admin_password, command='ald-admin cmd', timeout=3,
+                 logfile=None, delay=None):
+        self.admin = admin_password
+        self.child = pexpect.spawnu(command, timeout=timeout)
+        self.child.logfile = logfile
+        self.child.delaybeforesend = delay
+        self.child.expect_list([self.PROMPT])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, command, dialog=ADMIN_DIALOG, name='', value='',
+            ordered=False):
+        """Run command answering dialog prompts. Return output as str.
+
+        Output doesn't include the terminal echo of command. Return
+        when command prompt is back. Raise pexpect.TIMEOUT if
+        unexpected prompt blocks the command. If ordered is True then
+        raise DialogError if a prompt comes out of dialog order or
+        a required prompt is missed.
+        """
+        patterns = dialog.patterns(name) + [self.PROMPT]
+        output = []
+        position = 0
+        self.child.sendline(command)
+        while True:
+            index = self.child.expect_list(patterns)
+            output.append(self.child.before)
+            if index == len(patterns) - 1:
+                break
+            output.append(self.child.after)
+            if ordered:
+                if index not in dialog.allowed(position):
+                    raise DialogError("Prompt {0!r} out of order in "
+                                      "{1!r}".format(self.child.after,
+                                                     command))
+                position = index + 1
+            self.child.sendline(dialog.reply(index, name=name, value=value,
+                                             admin=self.admin))
+        if ordered and dialog.missing(position):
+            raise DialogError("No prompts {0} in {1!r}".format(
+                dialog.missing(position), command))
+        output = ''.join(output)
+        echo, newline, rest = output.partition('\n')
+        if echo.strip() == command:
+            output = rest
+        return output
+
+    def user_add(self, name, password, ordered=False):
+        """Create user with default settings. Return output as str."""
+        return self.run('user-add %s' % name, USER_ADD_DIALOG, name,
+                        password, ordered)
+
+    def group_add(self, name, description='', ordered=False):
+        """Create group with default GID. Return output as str."""
+        return self.run('group-add %s' % name, GROUP_ADD_DIALOG, name,
+                        description, ordered)
+
+    def add_users(self, users):
+        """Create users from dict {name: password}. Return dict.
+
+        Return dict {name: output of user-add}.
+        """
+        return {name: self.user_add(name, users[name]) for name in users}
+
+    def add_groups(self, groups):
+        """Create groups from list of names. Return dict.
+
+        Return dict {name: output of group-add}.
+        """
+        return {name: self.group_add(name) for name in groups}
+
+    def user_get(self, name):
+        """Get full user info. Return str."""
+        return self.run('user-get %s -f' % name, name=name)
+
+    def _list(self, command):
+        names = set()
+        for line in self.run(command).splitlines():
+            line = line.strip()
+            if line:
+                names.add(line)
+        return names
+
+    def user_list(self):
+        """Return set of user names."""
+        return self._list('user-list')
+
+    def group_list(self):
+        """Return set of group names."""
+        return self._list('group-list')
+
+    def verify_users(self, names):
+        """Check users exist with one user-list. Return missing list."""
+        existing = self.user_list()
+        return sorted(set(names) - existing)
+
+    def verify_groups(self, names):
+        """Check groups exist with one group-list. Return missing list."""
+        existing = self.group_list()
+        return sorted(set(names) - existing)
+
+    def close(self):
+        """Exit ald-admin. Return its exit status."""
+        if self.child.isalive():
+            self.child.sendline('exit')
+            self.child.expect(pexpect.EOF)
+            self.child.wait()
+        return self.child.exitstatus
@@ -0,0 +1,247 @@
+"""ALD databases lifecycle: init, destroy, snapshot and restore.
+
+ald-init init is the slowest step of the test suite. AldSnapshots
+saves ALD state directories (LDAP and Kerberos databases, their
+configuration and exported home directories) with the pass-file they
+were created with, and restores them much faster than a re-init.
+Snapshots are kept on disk between sessions.
+"""
+
+import os
+import json
+import shutil
+import shlex
+import string
+import random
+import subprocess
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+EXPORT_HOME = '/ald_export_home'
+# Directories and files holding ALD state: databases and everything
+# ald-init writes, so a snapshot is restored even after ald-init destroy.
+ALD_STATE = [
+    '/var/lib/ldap',
+    '/etc/ldap/slapd.d',
+    '/etc/ldap/ldap.conf',
+    '/var/lib/krb5kdc',
+    '/etc/krb5kdc',
+    '/etc/krb5.conf',
+    '/etc/krb5.keytab',
+    '/etc/ald',
+    '/var/lib/ald',
+    EXPORT_HOME
+]
+# Services to stop while state is copied, in order of stopping.
+ALD_SERVICES = [
+    'krb5-admin-server',
+    'krb5-kdc',
+    'slapd'
+]
+SNAPSHOT_DIR = '/var/tmp/ald-snapshots'
+
+
+def clean_dirs(export_dir):
+    """If export_dir isn't empty then remove all subdirectories."""
+    contain = os.listdir(export_dir)
+    count = 0
+    if contain:
+        for home in contain:
+            if os.path.isfile(os.path.join(export_dir, home)):
+                continue
+            shutil.rmtree(os.path.join(export_dir, home))
+            count += 1
+    return count
+
+
+def password_generator(length=8):
+    """Create random password. Return str."""
+    char_classes = [
+        string.ascii_lowercase,
+        string.ascii_uppercase,
+        string.digits,
+        string.punctuation
+    ]
+    password = ''
+    while len(password) < length:
+        if len(char_classes) > 0:
+            char_class = random.choice(char_classes)
+            char_classes.remove(char_class)
+        else:
+            char_class = string.ascii_letters + string.digits
+        char_class_count = random.randint(2, 3)
+
+        while char_class_count > 0:
+            password = password + random.choice(char_class)
+            char_class_count -= 1
+
+    return password[:length]
+
+
+def write_passwd(passwd):
+    """Write pass-file with new passwords. Return admin/admin password."""
+    admin_admin = password_generator()
+    km = password_generator()
+    with open(passwd, 'w') as pwd:
+        pwd.write("admin/admin:{a}\nK/M:{k}\n".format(a=admin_admin, k=km))
+    os.chmod(passwd, 0o0600)
+    return admin_admin
+
+
+def read_admin_password(passwd):
+    """Get admin/admin password from pass-file. Return str."""
+    with open(passwd) as pwd:
+        for line in pwd:
+            principal, password = line.rstrip('\n').split(':', 1)
+            if principal == 'admin/admin':
+                return password
+    raise ValueError("No admin/admin password in {}".format(passwd))
+
+
+def init_ald(passwd):
+    """Initialize ALD databases with passwords from pass-file."""
+    init = "ald-init init --force --pass-file={}".format(passwd)
+    subprocess.check_output(shlex.split(init))
+
+
+def destroy_ald(passwd):
+    """Destroy ALD databases and exported home directories."""
+    destroy = "ald-init destroy --force --pass-file={}".format(passwd)
+    subprocess.check_output(shlex.split(destroy))
+    clean_dirs(EXPORT_HOME)
+
+
+class AldSnapshots:
+    """Named snapshots of ALD state kept in directory.
+
+    Every snapshot is a directory with copies of state paths (copied
+    with 'cp -a', so owners, modes and xattrs incl. parsec labels are
+    kept; reflinks are used where FS supports it), the list of state
+    paths, the pass-file and optional JSON metadata. Snapshots taken
+    with another list of state paths are treated as missing.
+    Attribute current is the name of the last taken or restored
+    snapshot, None if ALD was changed since.
+    """
+    def __init__(self, directory=SNAPSHOT_DIR, state=ALD_STATE,
+                 services=ALD_SERVICES):
+        self.directory = directory
+        self.state = state
+        self.services = services
+        self.current = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _service(self, action, services):
+        for service in services:
+            subprocess.check_call(['service', service, action])
+
+    @staticmethod
+    def _copy(src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        subprocess.check_call(['cp', '-a', '--reflink=auto', src, dst])
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def exists(self, name):
+        """Check if snapshot exists and holds all state paths."""
+        snapshot = self._path(name)
+        if not os.path.exists(os.path.join(snapshot, 'passwd')):
+            return False
+        try:
+            with open(os.path.join(snapshot, 'state.json')) as fobj:
+                return json.load(fobj) == list(self.state)
+        except (OSError, ValueError):
+            return False
+
+    def take(self, name, passwd, meta=None):
+        """Save ALD state and pass-file as snapshot name.
+
+        Optional meta is JSON serializable object restored with
+        snapshot (e.g. names and passwords of seeded users).
+        """
+        snapshot = self._path(name)
+        tmp = snapshot + '.tmp'
+        self._remove(tmp)
+        os.makedirs(tmp)
+        self._service('stop', self.services)
+        try:
+            for path in self.state:
+                if os.path.lexists(path):
+                    self._copy(path, os.path.join(tmp, 'root') + path)
+        finally:
+            self._service('start', reversed(self.services))
+        shutil.copy2(passwd, os.path.join(tmp, 'passwd'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fobj:
+            json.dump(meta, fobj)
+        with open(os.path.join(tmp, 'state.json'), 'w') as fobj:
+            json.dump(list(self.state), fobj)
+        # Replace old snapshot only when new one is complete.
+        self._remove(snapshot)
+        os.rename(tmp, snapshot)
+        self.current = name
+
+    def restore(self, name, passwd):
+        """Restore ALD state and pass-file from snapshot. Return meta."""
+        snapshot = self._path(name)
+        assert self.exists(name), "No ALD snapshot {}".format(snapshot)
+        self._service('stop', self.services)
+        try:
+            for path in self.state:
+                self._remove(path)
+                saved = os.path.join(snapshot, 'root') + path
+                if os.path.lexists(saved):
+                    self._copy(saved, path)
+        finally:
+            self._service('start', reversed(self.services))
+        shutil.copy2(os.path.join(snapshot, 'passwd'), passwd)
+        self.current = name
+        with open(os.path.join(snapshot, 'meta.json')) as fobj:
+            return json.load(fobj)
+
+    def seed(self, name, passwd, open_session, users, base=None,
+             retake=False):
+        """Provide snapshot name with users added. Return dict.
+
+        If snapshot name exists and retake is False then restore it
+        and return users saved in it. Else restore snapshot base (if
+        given and ALD changed since), add users {name: password} in
+        session returned by open_session(), check them with one
+        user-list and take snapshot name with users as meta.
+        """
+        if self.exists(name) and not retake:
+            return self.restore(name, passwd)
+        if base is not None and self.current != base:
+            self.restore(base, passwd)
+        with open_session() as session:
+            session.add_users(users)
+            missing = session.verify_users(users)
+        assert not missing, "Users not created: {}".format(missing)
+        self.take(name, passwd, meta=users)
+        return users
+
+    def remove(self, name):
+        """Remove snapshot."""
+        self._remove(self._path(name))
+
+    def remove_all(self, keep=()):
+        """Remove all snapshots but names in keep. Return removed list.
+
+        Snapshots taken on top of a retaken snapshot are stale, so
+        remove them when the base is taken again.
+        """
+        removed = []
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                if name not in keep:
+                    self.remove(name)
+                    removed.append(name)
+        return removed
@@ -0,0 +1,99 @@
+"""Shared ALD fixtures.
+
+ALD databases are initialized once and saved as the 'base' snapshot.
+Every test module starts from that snapshot, which is restored only if
+a previous module changed ALD. Snapshots stay on disk, so the next
+session restores them instead of running ald-init init again. Use
+--ald-reinit to start from a fresh init; it drops all snapshots
+taken on top of the old base. ALD is left initialized at the end of
+session, use --ald-destroy to destroy it.
+"""
+
+import os
+import pytest
+from alddriver import AldAdminSession
+from aldstate import AldSnapshots, password_generator, write_passwd, \
+    read_admin_password, init_ald, destroy_ald
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+BASE_SNAPSHOT = 'base'
+PASSWD = '/tmp/ald-passwd'
+BULK_USERS = 200
+
+
+def pytest_addoption(parser):
+    parser.addoption('--ald-reinit', action='store_true',
+                     help='initialize ALD and retake its snapshots')
+    parser.addoption('--ald-destroy', action='store_true',
+                     help='destroy ALD databases at the end of session')
+
+
+@pytest.fixture(scope='session')
+def ald_snapshots():
+    """Return AldSnapshots."""
+    return AldSnapshots()
+
+
+@pytest.fixture(scope='session')
+def ald_base(request, ald_snapshots):
+    """Initialize ALD or restore it from snapshot.
+
+    With --ald-destroy destroy ALD databases at the end of session.
+    Return admin/admin password and path to pass-file.
+    """
+    if request.config.getoption('--ald-reinit') or \
+            not ald_snapshots.exists(BASE_SNAPSHOT):
+        # Snapshots of the old base are no longer valid.
+        ald_snapshots.remove_all()
+        write_passwd(PASSWD)
+        init_ald(PASSWD)
+        ald_snapshots.take(BASE_SNAPSHOT, PASSWD)
+    else:
+        ald_snapshots.restore(BASE_SNAPSHOT, PASSWD)
+
+    def destroyit():
+        """This finalizer destroys ALD databases."""
+        destroy_ald(PASSWD)
+        os.remove(PASSWD)
+
+    if request.config.getoption('--ald-destroy'):
+        request.addfinalizer(destroyit)
+    return read_admin_password(PASSWD), PASSWD
+
+
+@pytest.fixture(scope='module')
+def ald_fixture(request, ald_base, ald_snapshots):
+    """Provide pristine ALD databases. Return admin/admin password."""
+    if ald_snapshots.current != BASE_SNAPSHOT:
+        ald_snapshots.restore(BASE_SNAPSHOT, PASSWD)
+
+    def dirty():
+        """Tests of this module may have changed ALD."""
+        ald_snapshots.current = None
+
+    request.addfinalizer(dirty)
+    return ald_base
+
+
+@pytest.fixture(scope='module')
+def ald_bulk_users(request, ald_base, ald_snapshots):
+    """Provide ALD with BULK_USERS users. Return dict {name: password}.
+
+    Users are created once and kept in their own snapshot.
+    """
+    users = {'bulk%04d' % i: password_generator()
+             for i in range(BULK_USERS)}
+    users = ald_snapshots.seed(
+        'bulk-{}'.format(BULK_USERS), PASSWD,
+        lambda: AldAdminSession(ald_base[0]), users, base=BASE_SNAPSHOT,
+        retake=request.config.getoption('--ald-reinit'))
+
+    def dirty():
+        ald_snapshots.current = None
+
+    request.addfinalizer(dirty)
+    return users
@@ -0,0 +1,110 @@
+"""Test AldAdminSession against fake-ald-admin stand-in."""
+
+import os
+import sys
+import pytest
+import pexpect
+from alddriver import AldAdminSession, Dialog, DialogError, \
+    USER_ADD_DIALOG, GROUP_ADD_DIALOG
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'fake-ald-admin')
+
+
+@pytest.fixture(scope='function')
+def session(request):
+    """Open session with fake ald-admin. Return AldAdminSession."""
+    sess = AldAdminSession('admin-pwd',
+                           command='{0} {1} cmd'.format(sys.executable, FAKE))
+
+    def closeit():
+        assert sess.close() == 0
+
+    request.addfinalizer(closeit)
+    return sess
+
+
+def test_dialog_patterns():
+    """Static patterns are compiled once, named ones per name."""
+    dialog = Dialog([("static:", 'a'), (r"name \[%s\]:", '{name}')])
+    first = dialog.patterns('u.1')
+    second = dialog.patterns('u2')
+    assert first[0] is second[0]
+    assert first[1].search('name [u.1]:')
+    assert not first[1].search('name [ux1]:')
+    assert dialog.reply(1, name='u2') == 'u2'
+
+
+def test_bulk_users(session):
+    """Create many users in one session and verify with one list."""
+    users = {'user%03d' % i: 'Pa$$w0rd%d' % i for i in range(50)}
+    session.add_users(users)
+    assert session.verify_users(users) == []
+    assert session.verify_users(['nosuchuser']) == ['nosuchuser']
+
+
+def test_user_get(session):
+    session.user_add('ivanov', 'secret')
+    info = session.user_get('ivanov')
+    # Echo of command must not make names found in output.
+    assert 'user-get' not in info
+    assert 'Ошибка' not in info
+    assert '/ald_home/ivanov' in info
+    assert '/bin/bash' in info
+    assert 'ivanov,,,' in info
+
+
+def test_user_get_missing(session):
+    info = session.user_get('petrov')
+    assert 'user-get' not in info
+    assert 'Ошибка' in info
+
+
+def test_bulk_groups(session):
+    session.add_groups(['testers', 'devs'])
+    assert session.verify_groups(['testers', 'devs', 'Domain Users']) == []
+
+
+def test_ordered_dialogs(session):
+    """Real dialogs pass ordered check, admin prompt is optional."""
+    session.user_add('first', 'secret', ordered=True)
+    session.user_add('second', 'secret', ordered=True)
+    session.group_add('testers', ordered=True)
+    assert session.verify_users(['first', 'second']) == []
+
+
+def test_ordered_out_of_order():
+    """Command is left unanswered, so the session is not reused."""
+    sess = AldAdminSession('admin-pwd',
+                           command='{0} {1} cmd'.format(sys.executable, FAKE))
+    steps = USER_ADD_DIALOG.steps
+    # Password prompts swapped with UID prompt.
+    swapped = Dialog(steps[:1] + steps[3:4] + steps[1:3] + steps[4:])
+    with pytest.raises(DialogError):
+        sess.run('user-add petrov', swapped, 'petrov', 'secret',
+                 ordered=True)
+    sess.child.terminate(force=True)
+
+
+def test_ordered_missing_prompt(session):
+    """Command prompt came back before all required prompts."""
+    dialog = GROUP_ADD_DIALOG + Dialog([(r"Никогда не спросит:", '')])
+    with pytest.raises(DialogError):
+        session.run('group-add devs', dialog, 'devs', ordered=True)
+    # Any-order mode doesn't mind.
+    session.run('group-add qa', dialog, 'qa')
+    assert session.verify_groups(['devs', 'qa']) == []
+
+
+def test_unexpected_prompt():
+    """Unknown prompt must not hang forever."""
+    sess = AldAdminSession('admin-pwd', timeout=1,
+                           command='{0} {1} cmd'.format(sys.executable, FAKE))
+    with pytest.raises(pexpect.TIMEOUT):
+        sess.run('user-add stuck', Dialog([]), 'stuck')
+    sess.child.terminate(force=True)
@@ -0,0 +1,90 @@
+"""Test AldSnapshots on plain directories. Run without ALD."""
+
+import os
+import sys
+import pytest
+from alddriver import AldAdminSession
+from aldstate import AldSnapshots
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'fake-ald-admin')
+
+
+@pytest.fixture(scope='function')
+def fake_state(tmpdir):
+    """Make state paths in tmpdir. Return (AldSnapshots, db, conf)."""
+    db = tmpdir.mkdir('var').mkdir('ldap')
+    db.join('data.mdb').write('base')
+    conf = tmpdir.mkdir('etc').join('krb5.conf')
+    conf.write('realm')
+    tmpdir.join('passwd').write('admin/admin:pwd\n')
+    snapshots = AldSnapshots(directory=str(tmpdir.join('snapshots')),
+                             state=[str(db), str(conf)], services=[])
+    return snapshots, db, conf
+
+
+def test_take_restore(fake_state, tmpdir):
+    """Restore brings back files removed by destroy."""
+    snapshots, db, conf = fake_state
+    passwd = str(tmpdir.join('passwd'))
+    snapshots.take('base', passwd, meta={'user': 'pwd'})
+    db.join('data.mdb').write('changed')
+    conf.remove()
+    assert snapshots.restore('base', passwd) == {'user': 'pwd'}
+    assert db.join('data.mdb').read() == 'base'
+    assert conf.read() == 'realm'
+
+
+def test_state_change_invalidates(fake_state, tmpdir):
+    """Snapshot taken with other state paths is missing."""
+    snapshots, db, conf = fake_state
+    snapshots.take('base', str(tmpdir.join('passwd')))
+    assert snapshots.exists('base')
+    snapshots.state = [str(db)]
+    assert not snapshots.exists('base')
+
+
+def test_remove_all(fake_state, tmpdir):
+    snapshots, db, conf = fake_state
+    for name in ['base', 'bulk-200']:
+        snapshots.take(name, str(tmpdir.join('passwd')))
+    assert snapshots.remove_all(keep=['base']) == ['bulk-200']
+    assert snapshots.exists('base')
+    assert not snapshots.exists('bulk-200')
+
+
+def test_seed(fake_state, tmpdir):
+    """Users are added once, then restored from their snapshot."""
+    snapshots, db, conf = fake_state
+    passwd = str(tmpdir.join('passwd'))
+    snapshots.take('base', passwd)
+    sessions = []
+
+    def open_session():
+        session = AldAdminSession(
+            'admin-pwd', command='{0} {1} cmd'.format(sys.executable, FAKE))
+        sessions.append(session)
+        return session
+
+    users = {'bulk%04d' % i: 'Pa$$w0rd%d' % i for i in range(20)}
+    db.join('data.mdb').write('bulk')
+    assert snapshots.seed('bulk-20', passwd, open_session, users,
+                          base='base') == users
+    assert len(sessions) == 1
+    assert not sessions[0].child.isalive()
+    db.join('data.mdb').write('changed')
+    snapshots.current = None
+    assert snapshots.seed('bulk-20', passwd, open_session, {},
+                          base='base') == users
+    assert len(sessions) == 1
+    assert db.join('data.mdb').read() == 'bulk'
+    # Retake starts from base.
+    snapshots.seed('bulk-20', passwd, open_session, users, base='base',
+                   retake=True)
+    assert len(sessions) == 2
+    assert db.join('data.mdb').read() == 'base'
@@ -0,0 +1,38 @@
+"""Test users seeded by ald_bulk_users fixture."""
+
+import sys
+import pytest
+from alddriver import AldAdminSession
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+@pytest.fixture(scope='module')
+def bulk_session(request, ald_base, ald_bulk_users):
+    """Open ald-admin session on bulk users snapshot. Return tuple.
+
+    Return AldAdminSession and dict {name: password}.
+    """
+    session = AldAdminSession(ald_base[0], logfile=sys.stdout)
+
+    def closeit():
+        assert session.close() == 0
+
+    request.addfinalizer(closeit)
+    return session, ald_bulk_users
+
+
+def test_bulk_users_exist(bulk_session):
+    """All seeded users are in user-list."""
+    session, users = bulk_session
+    assert session.verify_users(users) == []
+
+
+def test_bulk_user_info(bulk_session):
+    session, users = bulk_session
+    user = sorted(users)[-1]
+    user_info = session.user_get(user)
+    assert 'Ошибка' not in user_info, user_info
+    assert '/ald_home/%s' % user in user_info
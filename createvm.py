@@ -23,6 +23,15 @@ import multiprocessing
 import argparse
 import time
 import smtplib
+import tempfile
+import hashlib
+import json
+import threading
+import queue
+import shlex
+import posixpath
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
 import paths
 import infomail
 
@@ -31,6 +40,37 @@ __author__ = 'vgol'
 __version__ = '1.0.1'
 
 
+# Compressed images: suffix and default zstd settings.
+# ZSTD_THREADS = 0 means one worker thread per CPU core.
+ZSTD_SUFFIX = '.zst'
+ZSTD_LEVEL = 3
+ZSTD_THREADS = 0
+
+# Checksum manifest written into every upload directory and the
+# digest cache kept in paths.upload.
+SUMS_FILE = 'SHA256SUMS'
+DIGEST_CACHE = '.sha256cache'
+# Index of all uploaded images kept in paths.upload.
+UPLOAD_INDEX = 'index.json'
+# Format of upload directory names.
+UPLOAD_DIR_FORMAT = '%d-%m-%Y'
+
+# Disk sizes before and after compaction are saved next to exported
+# image in file with this suffix (see VirtualMachine.compactvm()).
+COMPACT_SUFFIX = '.compact.json'
+
+# Seconds to wait for mail delivery before exit.
+MAIL_TIMEOUT = 300
+
+# Guest account (see shared/passwd1.sh) and the guest mount point of
+# host ~/git shared folder (see VirtualMachine._sharedfolders()).
+GUEST_USER = 'u'
+GUEST_PASSWORD = '1'
+GUEST_GIT = '/media/sf_git'
+# Seconds to wait for guest additions after VM start.
+GUEST_BOOT_TIMEOUT = 600
+
+
 class VirtualMachineExistsError(Exception):
     """VirtualMachine.checkvm() raise this exception if VM exists."""
     pass
@@ -118,8 +158,13 @@ class VirtualMachine:
                 raise
         return 0
 
-    def buildvm(self):
-        """Build and export the virtual machine."""
+    def buildvm(self, compact=False):
+        """Build and export the virtual machine.
+
+        If compact is True the guest zero-fills its free space (see
+        shared/zerofree.sh) and Packer leaves the VM registered and
+        not exported, so it is compacted and exported by compactvm().
+        """
         templ = os.path.join(self.dir, self.template)
         assert os.path.exists(templ), "%s not found" % self.template
         packer_main = os.path.join(paths.packer, 'bin', 'packer')
@@ -127,16 +172,65 @@ class VirtualMachine:
             "Packer executable -- %s -- not found" % packer_main
         curdir = os.getcwd()
         os.chdir(self.dir)
-        subprocess.call([packer_main, 'build', '-force',
-                         '-var', 'headless=true', self.template])
-        os.chdir(curdir)
-        return os.path.join(self.dir, paths.packer_export,
-                            self.name + '.ova')
+        try:
+            subprocess.check_call([packer_main, 'build', '-force',
+                                   '-var', 'headless=true',
+                                   '-var', 'compact=%s' % str(compact).lower(),
+                                   self.template])
+        finally:
+            os.chdir(curdir)
+        ova = os.path.join(self.dir, paths.packer_export, self.name + '.ova')
+        if compact:
+            self.compactvm(ova)
+        assert os.path.exists(ova), "Packer didn't export {}".format(ova)
+        return ova
+
+    def _disks(self):
+        """Get disk images attached to VM. Return list."""
+        info = subprocess.check_output(['VBoxManage', 'showvminfo',
+                                        self.name, '--machinereadable'])
+        disks = []
+        for line in info.decode().splitlines():
+            value = line.partition('=')[2].strip('"')
+            if value.lower().endswith(('.vdi', '.vmdk')):
+                disks.append(value)
+        return disks
+
+    def _export_opts(self):
+        """Get export options from Packer template. Return list."""
+        with open(os.path.join(self.dir, self.template)) as templ:
+            builder = json.load(templ)['builders'][0]
+        return builder.get('export_opts', [])
+
+    def compactvm(self, ova):
+        """Compact disks of registered VM and export it. Return tuple.
+
+        Return disk sizes before and after compaction in bytes. They
+        are saved into ova + COMPACT_SUFFIX too. VM is unregistered
+        and deleted at the end.
+        """
+        try:
+            disks = self._disks()
+            before = sum(os.path.getsize(disk) for disk in disks)
+            with open('/dev/null') as devnull:
+                for disk in disks:
+                    subprocess.check_call(['VBoxManage', 'modifymedium',
+                                           'disk', disk, '--compact'],
+                                          stdout=devnull)
+            after = sum(os.path.getsize(disk) for disk in disks)
+            subprocess.check_call(['VBoxManage', 'export', self.name,
+                                   '--output', ova] + self._export_opts())
+        finally:
+            subprocess.call(['VBoxManage', 'unregistervm', self.name,
+                             '--delete'])
+        with open(ova + COMPACT_SUFFIX, 'w') as fobj:
+            json.dump({'before': before, 'after': after}, fobj)
+        return before, after
 
     def _groupvm(self):
         group = '/' + paths.vm_group
-        subprocess.call(['VBoxManage', 'modifyvm', self.name,
-                         '--groups', group])
+        subprocess.check_call(['VBoxManage', 'modifyvm', self.name,
+                               '--groups', group])
         return self.name, group
 
     def _sharedfolders(self):
@@ -152,33 +246,241 @@ class VirtualMachine:
         return folders
 
     def importvm(self, ova):
-        """Import VM and group into paths.vm_group."""
-        assert os.path.exists(ova), "{} not found" % ova
-        subprocess.call(['VBoxManage', 'import', ova,
-                        '--options', 'keepallmacs'])
+        """Import VM and group into paths.vm_group.
+
+        If ova is zstd compressed it is imported from the pipe fed
+        by zstd (see ImageStream), no decompressed copy is written.
+        """
+        assert os.path.exists(ova), "{} not found".format(ova)
+        if ova.endswith(ZSTD_SUFFIX):
+            with ImageStream(ova) as fifo:
+                subprocess.check_call(['VBoxManage', 'import', fifo,
+                                       '--options', 'keepallmacs'])
+        else:
+            subprocess.check_call(['VBoxManage', 'import', ova,
+                                   '--options', 'keepallmacs'])
         time.sleep(10)
         grouped = self._groupvm()
         sfolders = self._sharedfolders()
         return grouped, sfolders
 
 
-def build_vm(vmname):
+def compress_image(image, level=ZSTD_LEVEL, threads=ZSTD_THREADS):
+    """Compress image with multithreaded zstd. Return str.
+
+    Write image + ZSTD_SUFFIX next to image and return its path.
+    """
+    dest = image + ZSTD_SUFFIX
+    cmd = ['zstd', '-q', '-f', '-{}'.format(level),
+           '-T{}'.format(threads), image, '-o', dest]
+    if level > 19:
+        cmd.insert(1, '--ultra')
+    subprocess.check_call(cmd)
+    return dest
+
+
+class ImageStream:
+    """Serve zstd compressed OVA as a named pipe.
+
+    Use as context manager, it returns the path to the pipe named
+    like the uncompressed OVA in a temporary directory. VBoxManage
+    reads OVA sequentially but opens it more than once (to read the
+    descriptor and then to import), so a feeder thread decompresses
+    the whole archive into the pipe on every open. Once a reader is
+    connected the path is replaced with a new pipe, so the next open
+    never gets the rest of the previous stream.
+    """
+    def __init__(self, archive):
+        self.archive = archive
+        self.workdir = None
+        self.fifo = None
+        self._done = threading.Event()
+        self._feeder = None
+        self._unzstd = None
+
+    def __enter__(self):
+        self.workdir = tempfile.mkdtemp(prefix='import-')
+        name = os.path.basename(self.archive)[:-len(ZSTD_SUFFIX)]
+        self.fifo = os.path.join(self.workdir, name)
+        self._new_fifo()
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+        return self.fifo
+
+    def __exit__(self, *exc):
+        self._done.set()
+        unzstd = self._unzstd
+        if unzstd is not None and unzstd.poll() is None:
+            unzstd.kill()
+        # Open the pipe for reading to unblock the feeder waiting for
+        # the next reader, and drain what is still written.
+        fd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while self._feeder.is_alive():
+                try:
+                    os.read(fd, 1 << 20)
+                except BlockingIOError:
+                    pass
+                self._feeder.join(0.1)
+        finally:
+            os.close(fd)
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _new_fifo(self):
+        tmp = self.fifo + '.new'
+        os.mkfifo(tmp, 0o0600)
+        os.replace(tmp, self.fifo)
+
+    def _feed(self):
+        while True:
+            # Blocks until the pipe is opened for reading.
+            with open(self.fifo, 'wb') as pipe, \
+                    open('/dev/null', 'w') as devnull:
+                self._new_fifo()
+                if self._done.is_set():
+                    break
+                # Reader may close pipe early, zstd then fails with
+                # EPIPE. Broken archive makes the import fail anyway.
+                self._unzstd = subprocess.Popen(['zstd', '-q', '-d', '-c',
+                                                 self.archive],
+                                                stdout=pipe, stderr=devnull)
+                self._unzstd.wait()
+
+
+def _data_extents(fd, size):
+    """Yield (offset, length) of data regions of file descriptor.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE. If OS or file system
+    doesn't support them the whole file is one data region.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as exc:
+            # ENXIO: there is only a hole up to the end of file.
+            if exc.errno == errno.ENXIO:
+                return
+            if exc.errno == errno.EINVAL:
+                yield offset, size - offset
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def _copy_range(fsrc, fdst, offset, length):
+    """Copy length bytes at offset between file descriptors.
+
+    copy_file_range() is used while it copies whole chunks. If it
+    copies less than asked the rest is copied with read() and write().
+    Raise OSError if src ends before length bytes are copied.
+    """
+    os.lseek(fsrc, offset, os.SEEK_SET)
+    os.lseek(fdst, offset, os.SEEK_SET)
+    in_kernel = hasattr(os, 'copy_file_range')
+    while length > 0:
+        done = None
+        if in_kernel:
+            chunk = min(length, 1 << 30)
+            try:
+                done = os.copy_file_range(fsrc, fdst, chunk)
+            except OSError as exc:
+                # Old kernels can't copy between file systems.
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS,
+                                     errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                in_kernel = False
+            else:
+                # Some file systems copy only part or nothing at all.
+                if done < chunk:
+                    in_kernel = False
+                done = done or None
+        if done is None:
+            data = os.read(fsrc, min(length, 1 << 20))
+            if not data:
+                raise OSError(errno.EIO, "Source ended {} bytes early"
+                              .format(length))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fdst, view):]
+            done = len(data)
+        length -= done
+
+
+def sparse_copy(src, dst):
+    """Copy file keeping holes. Return tuple of int.
+
+    Only allocated extents of src are read and written. Return
+    the number of bytes transferred and the logical size.
+    """
+    transferred = 0
+    with open(src, 'rb', buffering=0) as fsrc, \
+            open(dst, 'wb', buffering=0) as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for offset, length in _data_extents(fsrc.fileno(), size):
+            _copy_range(fsrc.fileno(), fdst.fileno(), offset, length)
+            transferred += length
+        fdst.truncate(size)
+    shutil.copystat(src, dst)
+    return transferred, size
+
+
+def sparse_move(src, dst):
+    """Move file keeping holes. Return tuple of int.
+
+    Rename if src and dst are on the same file system, else copy
+    with sparse_copy() and remove src. Return the number of bytes
+    transferred and the logical size.
+    Note that OVA written by Packer is a plain tar without holes, so
+    for exported images transferred equals the logical size. Only
+    sparse sources (raw VMDK, pre-allocated files) gain from it.
+    """
+    try:
+        os.rename(src, dst)
+        return 0, os.path.getsize(dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+    result = sparse_copy(src, dst)
+    os.unlink(src)
+    return result
+
+
+def build_vm(vmname, compact=False):
     """Build virtual machine. Remove existing if needed."""
     v_machine = VirtualMachine(vmname)
     try:
         v_machine.checkvm()
     except VirtualMachineExistsError:
         v_machine.removevm()
-    return v_machine.buildvm()
+    return v_machine.buildvm(compact)
 
 
-def just_import(ova):
+def _file_digest(path, algorithm):
+    """Calculate hex digest of the file. Return str."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def just_import(ova, stale=()):
     """Import VM and group it. Return str.
 
     Import VM from specified ova and return VM name.
-    If VM with such name already exists raise VirtualMachineExistsError.
+    If VM with such name already exists it is skipped, unless its
+    name is in stale: VMs left by interrupted or failed import
+    attempts are removed and imported again.
     """
     name = os.path.split(ova)[1].split('.')[0]
+    if name in stale:
+        return force_import(ova)
     v_machine = VirtualMachine(name)
     # This must throw exception if such VM already exists.
     try:
@@ -190,8 +492,11 @@ def just_import(ova):
     return name
 
 
-def force_import(ova):
-    """Import and group VM. Remove existing if needed."""
+def force_import(ova, stale=()):
+    """Import and group VM. Remove existing if needed.
+
+    Argument stale is accepted for compatibility with just_import().
+    """
     name = os.path.split(ova)[1].split('.')[0]
     v_machine = VirtualMachine(name)
     try:
@@ -202,25 +507,537 @@ def force_import(ova):
     return name
 
 
+def _sha256_worker(path):
+    """Pool worker for hash_files(). Return tuple of str."""
+    return path, _file_digest(path, 'sha256')
+
+
+def _cache_key(path):
+    """Make digest cache key from inode, size and mtime. Return str."""
+    st = os.stat(path)
+    return '{0}:{1}:{2}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def load_digest_cache(cache_file):
+    """Load digest cache. Return dict."""
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_image(filename):
+    """Check if filename is (compressed) OVA image. Return bool."""
+    return filename.endswith('.ova') or filename.endswith('.ova' + ZSTD_SUFFIX)
+
+
+def prune_digest_cache(cache, top):
+    """Drop cache keys not matching any image under top. Return int.
+
+    Return the number of dropped keys.
+    """
+    keys = set()
+    for root, _, files in os.walk(top):
+        for filename in files:
+            if _is_image(filename):
+                try:
+                    keys.add(_cache_key(os.path.join(root, filename)))
+                except FileNotFoundError:
+                    continue
+    stale = [key for key in cache if key not in keys]
+    for key in stale:
+        del cache[key]
+    return len(stale)
+
+
+def save_digest_cache(cache_file, cache):
+    """Atomically write digest cache."""
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'w') as fobj:
+        json.dump(cache, fobj, indent=1, sort_keys=True)
+    os.replace(tmp, cache_file)
+
+
+def hash_files(files, procs=None, cache=None):
+    """Calculate SHA256 of files in parallel. Return dict.
+
+    Files are hashed by a pool of procs processes (all CPU cores by
+    default). If cache dict is given then files with known inode,
+    size and mtime are not hashed again, and new digests are added
+    to cache. Return dict {path: digest}.
+    """
+    digests = {}
+    keys = {}
+    todo = []
+    for path in files:
+        if cache is not None:
+            keys[path] = _cache_key(path)
+            if keys[path] in cache:
+                digests[path] = cache[keys[path]]
+                continue
+        todo.append(path)
+    if len(todo) == 1:
+        digests.update([_sha256_worker(todo[0])])
+    elif todo:
+        procs = min(procs or multiprocessing.cpu_count(), len(todo))
+        with multiprocessing.Pool(processes=procs) as pool:
+            digests.update(pool.map(_sha256_worker, todo))
+    if cache is not None:
+        for path in todo:
+            cache[keys[path]] = digests[path]
+    return digests
+
+
+def write_sums(directory, cache_file=None):
+    """Write SUMS_FILE for all images in directory. Return str.
+
+    Use cache_file to skip hashing of unchanged images. Entries of
+    images removed from the cache_file directory tree are dropped.
+    """
+    images = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                    if _is_image(f))
+    cache = load_digest_cache(cache_file) if cache_file else None
+    digests = hash_files(images, cache=cache)
+    if cache_file:
+        prune_digest_cache(cache, os.path.dirname(os.path.abspath(cache_file)))
+        save_digest_cache(cache_file, cache)
+    sums = os.path.join(directory, SUMS_FILE)
+    with open(sums + '.tmp', 'w') as fobj:
+        for image in images:
+            fobj.write('{0}  {1}\n'.format(digests[image],
+                                           os.path.basename(image)))
+    os.replace(sums + '.tmp', sums)
+    os.chmod(sums, 0o0644)
+    return sums
+
+
+def read_sums(sums):
+    """Parse sha256sum style manifest. Return dict {name: digest}."""
+    result = {}
+    with open(sums) as fobj:
+        for line in fobj:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            digest, name = line.split(None, 1)
+            # Strip binary mode mark.
+            result[name.lstrip('*')] = digest
+    return result
+
+
+def verify_sums(directory, procs=None):
+    """Check images in directory against SUMS_FILE. Return list.
+
+    Print result for every image as sha256sum -c does. Return
+    the list of missing or corrupted images.
+    """
+    expected = read_sums(os.path.join(directory, SUMS_FILE))
+    present = [name for name in sorted(expected)
+               if os.path.exists(os.path.join(directory, name))]
+    digests = hash_files([os.path.join(directory, n) for n in present],
+                         procs=procs)
+    failed = []
+    for name in sorted(expected):
+        path = os.path.join(directory, name)
+        if path not in digests:
+            print("{}: MISSING".format(name), file=stderr)
+            failed.append(name)
+        elif digests[path] != expected[name]:
+            print("{}: FAILED".format(name), file=stderr)
+            failed.append(name)
+        else:
+            print("{}: OK".format(name))
+    return failed
+
+
+def load_index(root):
+    """Load upload index from root. Return dict."""
+    try:
+        with open(os.path.join(root, UPLOAD_INDEX)) as fobj:
+            return json.load(fobj, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return OrderedDict([('roles', OrderedDict())])
+
+
+def update_index(upload_dir, root):
+    """Add images of upload_dir to the index in root. Return dict.
+
+    Index maps VM role to the list of versions sorted by date (ISO
+    format, so it sorts right). Every version has upload directory
+    name and files with their sizes and SHA256 digests taken from
+    SUMS_FILE. Only the entries of upload_dir are rewritten.
+    """
+    dirname = os.path.basename(os.path.normpath(upload_dir))
+    date = time.strftime('%Y-%m-%d', time.strptime(dirname,
+                                                   UPLOAD_DIR_FORMAT))
+    digests = read_sums(os.path.join(upload_dir, SUMS_FILE))
+    files = {}
+    for name in sorted(digests):
+        files.setdefault(vm_name(name), OrderedDict())[name] = OrderedDict([
+            ('size', os.path.getsize(os.path.join(upload_dir, name))),
+            ('sha256', digests[name])
+        ])
+    index = load_index(root)
+    roles = index['roles']
+    # Forget images replaced or removed from upload_dir.
+    for role in roles:
+        roles[role] = [v for v in roles[role] if v['dir'] != dirname]
+    for role, images in files.items():
+        versions = roles.setdefault(role, [])
+        versions.append(OrderedDict([('date', date), ('dir', dirname),
+                                     ('files', images)]))
+        versions.sort(key=lambda version: version['date'])
+    for role in [r for r in roles if not roles[r]]:
+        del roles[role]
+    tmp = os.path.join(root, UPLOAD_INDEX + '.tmp')
+    with open(tmp, 'w') as fobj:
+        json.dump(index, fobj, indent=1)
+    os.chmod(tmp, 0o0644)
+    os.replace(tmp, os.path.join(root, UPLOAD_INDEX))
+    return index
+
+
+def latest_images(roles, root):
+    """Find the newest image of every role in index. Return list.
+
+    Uncompressed image is preferred if both are uploaded.
+    """
+    index = load_index(root)['roles']
+    images = []
+    for role in roles:
+        if role not in index:
+            print("{} not found in upload index".format(role), file=stderr)
+            continue
+        latest = index[role][-1]
+        names = sorted(latest['files'], key=lambda n: n.endswith(ZSTD_SUFFIX))
+        images.append(os.path.join(root, latest['dir'], names[0]))
+    return images
+
+
+def _guestrun(vm, args, user=GUEST_USER, password=GUEST_PASSWORD):
+    """Make command running args in guest. Return list."""
+    return ['VBoxManage', 'guestcontrol', vm, 'run',
+            '--username', user, '--password', password,
+            '--wait-stdout', '--wait-stderr',
+            '--exe', args[0], '--'] + args
+
+
+def wait_for_guest(vm, timeout=None, interval=10):
+    """Wait until guest control works in vm.
+
+    Raise RuntimeError after timeout seconds (GUEST_BOOT_TIMEOUT by
+    default).
+    """
+    if timeout is None:
+        timeout = GUEST_BOOT_TIMEOUT
+    deadline = time.time() + timeout
+    with open('/dev/null', 'w') as devnull:
+        while subprocess.call(_guestrun(vm, ['/bin/true']), stdout=devnull,
+                              stderr=devnull):
+            if time.time() > deadline:
+                raise RuntimeError("{} didn't boot in {} s".format(vm,
+                                                                   timeout))
+            time.sleep(interval)
+
+
+def run_guest_tests(vm, suites, report_dir, keep_running=False):
+    """Run pytest suites in vm. Return path to JUnit report.
+
+    Start vm headless, wait for guest additions and run pytest as root
+    on suites (paths relative to host ~/git, seen in guest through
+    GUEST_GIT shared folder). Output is printed as it comes, each line
+    prefixed with VM name. JUnit report is copied into report_dir.
+    Power off vm afterwards unless keep_running is True.
+    """
+    with open('/dev/null', 'w') as devnull:
+        subprocess.check_call(['VBoxManage', 'startvm', vm,
+                               '--type', 'headless'], stdout=devnull)
+    try:
+        wait_for_guest(vm)
+        junit = '/tmp/junit-{}.xml'.format(vm)
+        guest_suites = [posixpath.join(GUEST_GIT, suite) for suite in suites]
+        script = "echo {pwd} | sudo -S python3 -m pytest -p no:cacheprovider" \
+                 " --junitxml={junit} {suites}"
+        script = script.format(pwd=shlex.quote(GUEST_PASSWORD), junit=junit,
+                               suites=' '.join(map(shlex.quote,
+                                                   guest_suites)))
+        proc = subprocess.Popen(_guestrun(vm, ['/bin/bash', '-c', script]),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        for line in proc.stdout:
+            print("[{0}] {1}".format(vm, line.decode(errors='replace')
+                                     .rstrip()), flush=True)
+        proc.wait()
+        report = os.path.join(report_dir, 'junit-{}.xml'.format(vm))
+        with open(report, 'wb') as fobj:
+            fobj.write(subprocess.check_output(_guestrun(vm, ['/bin/cat',
+                                                              junit])))
+    finally:
+        if not keep_running:
+            subprocess.call(['VBoxManage', 'controlvm', vm, 'poweroff'])
+    return report
+
+
+def merge_junit(reports, output):
+    """Merge JUnit reports of VMs into output. Return dict of totals.
+
+    Every test suite and test case class name is prefixed with VM name
+    taken from report file name (junit-VM.xml).
+    """
+    counters = ['tests', 'failures', 'errors', 'skipped']
+    totals = dict.fromkeys(counters, 0)
+    merged = ElementTree.Element('testsuites')
+    for report in reports:
+        vm = os.path.basename(report)[len('junit-'):-len('.xml')]
+        root = ElementTree.parse(report).getroot()
+        suites = [root] if root.tag == 'testsuite' else root.iter('testsuite')
+        for suite in suites:
+            suite.set('name', '{0}.{1}'.format(vm, suite.get('name', '')))
+            for case in suite.iter('testcase'):
+                case.set('classname', '{0}.{1}'.format(
+                    vm, case.get('classname', '')))
+            for counter in counters:
+                totals[counter] += int(suite.get(counter, 0))
+            merged.append(suite)
+    for counter in counters:
+        merged.set(counter, str(totals[counter]))
+    ElementTree.ElementTree(merged).write(output, encoding='utf-8',
+                                          xml_declaration=True)
+    return totals
+
+
 def count_workers():
     """Determine a number of processes for pool. Return int."""
     return multiprocessing.cpu_count() // 2
 
 
+def vm_name(image):
+    """Get VM name from image path. Return str."""
+    return os.path.split(image)[1].split('.')[0]
+
+
+class Journal:
+    """On-disk journal of per-VM state of build or import batch.
+
+    The journal is a JSON file mapping VM name to its state, source
+    (VM name or image path), number of attempts, result and last
+    error. It is rewritten atomically on every change, so after a
+    failure or a host reboot the batch can be resumed from it.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    BUILT = 'built'
+    IMPORTED = 'imported'
+    UPLOADED = 'uploaded'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fobj:
+                self.entries = json.load(fobj, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            self.entries = OrderedDict()
+
+    def __str__(self):
+        counts = OrderedDict()
+        for entry in self.entries.values():
+            counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        states = ', '.join("{0} {1}".format(count, state)
+                           for state, count in counts.items())
+        return "Journal {0}: {1}".format(self.path, states or 'empty')
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fobj:
+            json.dump(self.entries, fobj, indent=1)
+        os.replace(tmp, self.path)
+
+    def start(self, sources):
+        """Begin new batch. Forget previous one. Mark all queued."""
+        with self._lock:
+            self.entries = OrderedDict()
+            for source in sources:
+                self.entries[vm_name(source)] = {'state': self.QUEUED,
+                                                  'source': source,
+                                                  'attempts': 0}
+            self._save()
+
+    def update(self, name, state, **info):
+        """Set new state of VM and save journal."""
+        with self._lock:
+            entry = self.entries.setdefault(name, {'attempts': 0})
+            entry['state'] = state
+            if state == self.RUNNING:
+                entry['attempts'] += 1
+                entry.pop('error', None)
+            entry['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            entry.update(info)
+            self._save()
+
+    def select(self, *states, max_attempts=None):
+        """Return list of sources of VMs in given states.
+
+        If max_attempts specified then skip VMs already tried
+        max_attempts times.
+        """
+        return [entry['source'] for entry in self.entries.values()
+                if entry['state'] in states and
+                (max_attempts is None or entry['attempts'] < max_attempts)]
+
+    def results(self, *states):
+        """Return list of results of VMs in given states."""
+        return [entry['result'] for entry in self.entries.values()
+                if entry['state'] in states and 'result' in entry]
+
+
+class Notifier:
+    """Background mail sender.
+
+    Messages put by send() are queued and delivered by a worker
+    thread, so an SMTP stall doesn't block the caller. One SMTP
+    connection is reused for all queued messages and closed after
+    idle seconds without messages. Temporary failures are retried
+    up to retries times with exponential backoff (backoff, 2*backoff,
+    ...), but one message is given up after budget seconds, so the
+    default fits MAIL_TIMEOUT. Call close() to deliver the rest and
+    stop the worker, then check undelivered().
+    """
+    errpref = "SMTP Problem:"
+
+    def __init__(self, host=infomail.smtphost, port=infomail.smtpport,
+                 retries=5, backoff=5, idle=60, timeout=60,
+                 budget=MAIL_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = idle
+        self.timeout = timeout
+        self.budget = budget
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self._conn = None
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def send(self, fromaddr, toaddrs, message):
+        """Queue message (str or email.message.Message) for delivery."""
+        if not isinstance(message, str):
+            message = message.as_string()
+        self.queued += 1
+        self._queue.put((fromaddr, toaddrs, message))
+
+    def close(self, timeout=None):
+        """Deliver queued messages and stop. Return True if done.
+
+        Wait at most timeout seconds (forever if None).
+        """
+        self._queue.put(None)
+        self._worker.join(timeout)
+        return not self._worker.is_alive()
+
+    def undelivered(self):
+        """Return number of messages failed or not sent yet."""
+        return self.queued - self.sent
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._conn = None
+
+    def _deliver(self, fromaddr, toaddrs, message):
+        """Send message retrying temporary failures. Return bool."""
+        give_up = time.monotonic() + self.budget
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                if time.monotonic() + delay >= give_up:
+                    print(self.errpref, "Giving up after {} s".format(
+                        self.budget), file=stderr)
+                    break
+                time.sleep(delay)
+            # No SMTP operation may outlast the budget.
+            timeout = max(min(self.timeout, give_up - time.monotonic()), 1)
+            try:
+                if self._conn is None:
+                    self._conn = smtplib.SMTP(self.host, self.port,
+                                              timeout=timeout)
+                else:
+                    self._conn.sock.settimeout(timeout)
+                self._conn.sendmail(fromaddr, toaddrs, message)
+                return True
+            except smtplib.SMTPRecipientsRefused:
+                print(self.errpref, "All recipients {} refused".format(
+                    toaddrs), file=stderr)
+                return False
+            except smtplib.SMTPSenderRefused as exc:
+                print(self.errpref, "Server didn't accept sender", fromaddr,
+                      file=stderr)
+                if exc.smtp_code >= 500:
+                    return False
+            except smtplib.SMTPDataError as exc:
+                print(self.errpref, "Server didn't accept mail data",
+                      file=stderr)
+                if exc.smtp_code >= 500:
+                    return False
+            except smtplib.SMTPHeloError:
+                print(self.errpref, "Server didn't reply properly to the "
+                      "HELLO", file=stderr)
+                self._disconnect()
+            except (smtplib.SMTPException, OSError) as exc:
+                print(self.errpref, repr(exc), file=stderr)
+                # Connection is broken, don't try to QUIT.
+                self._conn = None
+        return False
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            if item is None:
+                break
+            if self._deliver(*item):
+                self.sent += 1
+            else:
+                self.failed += 1
+        self._disconnect()
+
+
 class VMHandler:
     """Base class for dealing with lists of VirtualMachines
 
-    This class must be subclassed.
+    This class must be subclassed. Subclasses set _DONE to the
+    journal state of successfully handled VM.
+    Optional argument journal is Journal instance to record state
+    of every VM in.
     """
     _TIMEOUT = 30
-    results = []
+    _DONE = None
 
-    def __init__(self, vmlist, threads=count_workers()):
+    def __init__(self, vmlist, threads=count_workers(), journal=None):
         if isinstance(vmlist, str):
             self.vmlist = [vmlist]
         else:
             self.vmlist = vmlist
         self.threads = threads
+        self.journal = journal
+        self.results = []
+        # VM name: seconds spent to handle it.
+        self.durations = {}
 
     def __str__(self):
         return "VM list:\n%s" % '\n'.join(self.vmlist)
@@ -229,43 +1046,126 @@ class VMHandler:
         print("{} successfully handled".format(vm))
         self.results.append(vm)
 
+    def _mark(self, name, state, **info):
+        """Record VM state if journal is used."""
+        if self.journal is not None:
+            self.journal.update(name, state, **info)
+
+    def _handlers(self, name):
+        """Make success and error callbacks for VM. Return tuple."""
+        started = time.time()
+
+        def success(result):
+            self.durations[name] = int(time.time() - started)
+            self._callback(result)
+            self._mark(name, self._DONE, result=result,
+                       duration=self.durations[name])
+
+        def error(exc):
+            self.durations[name] = int(time.time() - started)
+            print("{0} failed: {1!r}".format(name, exc), file=stderr)
+            self._mark(name, Journal.FAILED, error=repr(exc),
+                       duration=self.durations[name])
+        return success, error
+
+    def _run_one(self, func, item, *args):
+        """Handle single VM in current process."""
+        name = vm_name(item)
+        success, error = self._handlers(name)
+        self._mark(name, Journal.RUNNING, source=item)
+        try:
+            result = func(item, *args)
+        except Exception as exc:
+            error(exc)
+        else:
+            success(result)
 
-class Builder(VMHandler):
-    """Build given list of virtual machines.
-
-    Constructor require list of VMs as first positional argument.
-    It is safe to specify single string here.
-    Optional argument threads specify the count of worker processes
-    those will actually build VMs from vmlist. The default is
-    multiprocessing.cpu_count().
-    """
-    def _build_pool(self, procs, lst):
+    def _run_pool(self, procs, lst, func, *args):
+        """Handle VMs from lst in pool of procs processes."""
         pool = multiprocessing.Pool(processes=procs)
-        for vm in lst:
-            pool.apply_async(build_vm, args=(vm,), callback=self._callback)
+        for item in lst:
+            success, error = self._handlers(vm_name(item))
+            self._mark(vm_name(item), Journal.RUNNING, source=item)
+            pool.apply_async(func, args=(item,) + args,
+                             callback=success, error_callback=error)
             time.sleep(self._TIMEOUT)
         pool.close()
         pool.join()
 
-    def build(self):
-        """Build VMs from self.vmlist."""
+    def _run(self, func, *args):
+        """Handle all VMs from self.vmlist. Return self.results."""
         vm_number = len(self.vmlist)
-        if vm_number == 1:
-            ova = build_vm(self.vmlist[0])
-            self.results.append(ova)
+        if vm_number == 0:
+            pass
+        elif vm_number == 1:
+            self._run_one(func, self.vmlist[0], *args)
         elif vm_number <= self.threads:
-            self._build_pool(vm_number, self.vmlist)
+            self._run_pool(vm_number, self.vmlist, func, *args)
         else:
             tmplist = self.vmlist
             while tmplist:
-                self._build_pool(self.threads, tmplist[:self.threads])
+                self._run_pool(self.threads, tmplist[:self.threads],
+                               func, *args)
                 tmplist = tmplist[self.threads:]
         return self.results
 
+
+class Builder(VMHandler):
+    """Build given list of virtual machines.
+
+    Constructor require list of VMs as first positional argument.
+    It is safe to specify single string here.
+    Optional argument threads specify the count of worker processes
+    those will actually build VMs from vmlist. The default is
+    multiprocessing.cpu_count().
+    Optional argument journal is Journal instance to record the
+    state of every VM in.
+    If optional argument compact is True then free space is zeroed
+    in guests and disks are compacted before export. Call
+    compact_report() after build() to see the gain.
+    """
+    _DONE = Journal.BUILT
+
+    def __init__(self, vmlist, threads=count_workers(), journal=None,
+                 compact=False):
+        super().__init__(vmlist, threads, journal)
+        self.compact_disks = compact
+
+    def build(self):
+        """Build VMs from self.vmlist.
+
+        If journal is used then images built but not uploaded by
+        previous runs are added to results too.
+        """
+        self._run(build_vm, self.compact_disks)
+        if self.journal is not None:
+            self.results = self.journal.results(Journal.BUILT)
+        return self.results
+
+    def compact_report(self):
+        """Print disk sizes before and after compaction. Return list.
+
+        Return the list of tuples (image, size before, size after)
+        for every image from self.results compacted by compactvm().
+        """
+        report = []
+        for image in self.results:
+            try:
+                with open(image + COMPACT_SUFFIX) as fobj:
+                    sizes = json.load(fobj)
+            except (OSError, ValueError):
+                print("{}: no compaction data".format(
+                    os.path.basename(image)), file=stderr)
+                continue
+            print("{0}: disk {1} -> {2} bytes".format(
+                vm_name(image), sizes['before'], sizes['after']))
+            report.append((image, sizes['before'], sizes['after']))
+        return report
+
     @staticmethod
     def _upload_dir():
         """Create the directory using current date."""
-        upldir = os.path.join(paths.upload, time.strftime('%d-%m-%Y'))
+        upldir = os.path.join(paths.upload, time.strftime(UPLOAD_DIR_FORMAT))
         print("Upload directory: {}".format(upldir))
         try:
             os.mkdir(upldir)
@@ -286,8 +1186,14 @@ class Builder(VMHandler):
             os.unlink(img)
             return img
 
-    def upload(self, ignore_missing=True):
-        """Move VM images to paths.upload directory."""
+    def upload(self, ignore_missing=True, compress=False, keep_raw=True,
+               level=ZSTD_LEVEL, threads=ZSTD_THREADS):
+        """Move VM images to paths.upload directory.
+
+        If compress is True then publish zstd compressed copy of every
+        image using given level and number of threads. If keep_raw
+        is False the uncompressed image is removed afterwards.
+        """
         assert self.results, "Parameter 'results' is empty."
         upload_to = self._upload_dir()
         uploaded = []
@@ -296,8 +1202,10 @@ class Builder(VMHandler):
             dest = os.path.join(upload_to, basename)
             self._remove_existing(dest)
             try:
-                shutil.move(image, upload_to)
+                transferred, size = sparse_move(image, dest)
                 os.chmod(dest, 0o0644)
+                print("{0}: {1} of {2} bytes transferred".format(
+                    basename, transferred, size))
             except IOError as imgexc:
                 # If ignore_missing is True then check for errno.
                 # Else raise exception.
@@ -305,13 +1213,28 @@ class Builder(VMHandler):
                     # Do not raise exception if image file not found.
                     if (imgexc.errno == errno.ENOENT and
                             imgexc.filename == image):
-                        print("{} is missing. Skipping...", file=stderr)
+                        print("{} is missing. Skipping...".format(image),
+                              file=stderr)
+                        self._mark(vm_name(image), Journal.FAILED,
+                                   error='image is missing')
                     else:
                         raise
                 else:
                     raise
             else:
-                uploaded.append(os.path.split(image)[1])
+                self._mark(vm_name(image), Journal.UPLOADED,
+                           result=dest)
+                if compress:
+                    self._remove_existing(dest + ZSTD_SUFFIX)
+                    archive = compress_image(dest, level, threads)
+                    os.chmod(archive, 0o0644)
+                    uploaded.append(os.path.split(archive)[1])
+                    if not keep_raw:
+                        os.unlink(dest)
+                        continue
+                uploaded.append(basename)
+        write_sums(upload_to, os.path.join(paths.upload, DIGEST_CACHE))
+        update_index(upload_to, paths.upload)
         return upload_to, uploaded
 
     @staticmethod
@@ -325,36 +1248,91 @@ class Builder(VMHandler):
                                      charset='utf-8')
         return msg_mime
 
-    def mail(self, upload_dir):
+    def report(self, upload_dir):
+        """Make per-VM build report. Return list of dicts.
+
+        Every dict has VM name, status, uploaded OVA size, build
+        duration in seconds and SHA256 digest (None if unknown).
+        If journal is used then size and digest are given only for
+        VMs uploaded by this run: upload_dir may hold older images of
+        VMs failed now.
+        """
+        sums = os.path.join(upload_dir, SUMS_FILE)
+        digests = read_sums(sums) if os.path.exists(sums) else {}
+        if self.journal is not None:
+            names = list(self.journal.entries)
+        else:
+            names = [vm_name(vm) for vm in self.vmlist]
+        rows = []
+        for name in names:
+            entry = {}
+            if self.journal is not None:
+                entry = self.journal.entries[name]
+            image = os.path.join(upload_dir, name + '.ova')
+            size = None
+            if entry.get('state', Journal.UPLOADED) != Journal.UPLOADED:
+                image = None
+            elif os.path.exists(image):
+                size = os.path.getsize(image)
+            elif os.path.exists(image + ZSTD_SUFFIX):
+                image += ZSTD_SUFFIX
+                size = os.path.getsize(image)
+            if size is not None:
+                status = entry.get('state', Journal.UPLOADED)
+            else:
+                status = entry.get('state', Journal.FAILED)
+            rows.append(OrderedDict([
+                ('vm', name),
+                ('status', status),
+                ('size', size),
+                ('duration', self.durations.get(name,
+                                                entry.get('duration'))),
+                ('sha256', digests.get(os.path.basename(image))
+                           if size is not None else None)
+            ]))
+        return rows
+
+    @staticmethod
+    def _format_report(rows):
+        """Format report rows as text table. Return str."""
+        def size(value):
+            if value is None:
+                return '-'
+            return '{:.2f} GiB'.format(value / 2 ** 30)
+
+        def duration(value):
+            if value is None:
+                return '-'
+            return '{0}m {1:02d}s'.format(value // 60, value % 60)
+        line = "{0:<10} {1:<9} {2:>10} {3:>9}  {4}"
+        lines = [line.format('VM', 'Status', 'Size', 'Build', 'SHA256')]
+        for row in rows:
+            lines.append(line.format(
+                row['vm'], row['status'], size(row['size']),
+                duration(row['duration']), row['sha256'] or '-'))
+        return '\n'.join(lines)
+
+    def mail(self, upload_dir, notifier=None):
         """Send info mail using data from imfomail.py
 
         Argument upload_dir required for making download URL
          for recipients.
-        Prepare and send message through smtplib.SMTP
+        The message contains per-VM report (see report()).
+        If notifier (Notifier instance) is given the message is
+        queued there and the method returns at once. Else it is
+        sent through a new Notifier and the method waits for it.
         """
         url = infomail.download_url.format(os.path.split(upload_dir)[1])
         mymessage = infomail.text_message.format(url)
+        mymessage += self._format_report(self.report(upload_dir)) + '\n'
         mymessage = self._prepare_message(mymessage)
-        errpref = "SMTP Problem:"
-        smtpconn = smtplib.SMTP(infomail.smtphost, infomail.smtpport)
-        try:
-            smtpconn.sendmail(infomail.fromaddr,
-                              infomail.toaddrs,
-                              mymessage.as_string())
-        except smtplib.SMTPRecipientsRefused:
-            print(errpref, end=' ', file=stderr)
-            print("All recipients {} refused".format(infomail.toaddrs),
-                  file=stderr)
-        except smtplib.SMTPHeloError:
-            print(errpref, end=' ', file=stderr)
-            print("Server didn't reply properly to the HELLO", file=stderr)
-        except smtplib.SMTPSenderRefused:
-            print(errpref, "Server didn't accept sender", infomail.fromaddr,
-                  file=stderr)
-        except smtplib.SMTPDataError:
-            print(errpref, "Server didn't accept mail data", file=stderr)
-        finally:
-            smtpconn.quit()
+        if notifier is None:
+            sender = Notifier()
+            sender.send(infomail.fromaddr, infomail.toaddrs, mymessage)
+            sender.close()
+        else:
+            notifier.send(infomail.fromaddr, infomail.toaddrs, mymessage)
+        return mymessage
 
 
 class Importer(VMHandler):
@@ -366,28 +1344,41 @@ class Importer(VMHandler):
     those will actually import VMs from vmlist. The default is
     multiprocessing.cpu_count().
     """
-    def _import_pool(self, procs, lst, func):
-        pool = multiprocessing.Pool(processes=procs)
-        for vm in lst:
-            pool.apply_async(func, args=(vm,), callback=self._callback)
-            time.sleep(self._TIMEOUT)
-        pool.close()
-        pool.join()
+    _DONE = Journal.IMPORTED
+
+    def vmimport(self, func=just_import, stale=()):
+        """Import virtual machines from self.vmlist.
+
+        Names in stale are VMs left by previous attempts (see
+        just_import()).
+        """
+        return self._run(func, list(stale))
 
-    def vmimport(self, func=just_import):
-        """Import virtual machines from self.vmlist."""
-        ovas = len(self.vmlist)
-        if ovas == 1:
-            vmname = func(self.vmlist[0])
-            self.results.append(vmname)
-        elif ovas <= self.threads:
-            self._import_pool(ovas, self.vmlist, func)
-        else:
-            tmplist = self.vmlist
-            while tmplist:
-                self._import_pool(self.threads, tmplist[:self.threads], func)
-                tmplist = tmplist[self.threads:]
-        return self.results
+
+class Tester(VMHandler):
+    """Run pytest suites in given list of imported virtual machines.
+
+    Constructor require list of VM names as first positional argument.
+    It is safe to specify single string here.
+    Optional argument threads specify the count of VMs tested at once.
+    """
+    # VMs are already imported, nothing to stagger.
+    _TIMEOUT = 0
+
+    def test(self, suites, output='junit.xml', keep_running=False):
+        """Test VMs from self.vmlist. Return dict of totals.
+
+        Merge reports of all VMs into output JUnit file.
+        """
+        report_dir = tempfile.mkdtemp(prefix='junit-')
+        try:
+            self._run(run_guest_tests, suites, report_dir, keep_running)
+            totals = merge_junit(self.results, output)
+        finally:
+            shutil.rmtree(report_dir, ignore_errors=True)
+        missing = len(self.vmlist) - len(self.results)
+        totals['vms_failed'] = missing
+        return totals
 
 
 class Interface:
@@ -411,6 +1402,7 @@ class Interface:
                     and build VMs.
                     """
         parser_build = subparsers.add_parser('build', help=build_help)
+        parser_build.set_defaults(command='build')
         parser_build.add_argument('VM_NAME',
                                   nargs='*',
                                   help='virtual machine name'
@@ -419,23 +1411,119 @@ class Interface:
                                   action='store_true',
                                   help='send mail about new VM images'
                                   )
+        parser_build.add_argument('-c', '--compact',
+                                  action='store_true',
+                                  help='zero free space and compact images'
+                                  )
+        parser_build.add_argument('-z', '--zstd',
+                                  action='store_true',
+                                  help='also upload zstd compressed images'
+                                  )
+        parser_build.add_argument('--zstd-only',
+                                  action='store_true',
+                                  help='upload only zstd compressed images'
+                                  )
+        parser_build.add_argument('--level',
+                                  type=int,
+                                  default=ZSTD_LEVEL,
+                                  help='zstd compression level (default: '
+                                       '%(default)s)'
+                                  )
+        parser_build.add_argument('--threads',
+                                  type=int,
+                                  default=ZSTD_THREADS,
+                                  help='zstd worker threads, 0 means one '
+                                       'per CPU core (default: %(default)s)'
+                                  )
+        self._add_journal_args(parser_build)
 
         # Create parser for import command.
         import_help = """Import specified virtual machines and group
                     then into 'smolensk_unstable'. If a directory
                     given as argument all images from directory
-                    will be imported.
+                    will be imported. Images compressed with zstd
+                    (.ova.zst) are imported through a pipe without
+                    writing decompressed copy.
                     """
         parser_import = subparsers.add_parser('import', help=import_help)
+        parser_import.set_defaults(command='import')
         parser_import.add_argument('NAME',
-                                   nargs='+',
+                                   nargs='*',
                                    help='path to image or directory'
                                    )
         parser_import.add_argument('-f', '--force',
                                    action='store_true',
                                    help='delete existing VMs'
                                    )
+        parser_import.add_argument('-l', '--latest',
+                                   nargs='+',
+                                   metavar='ROLE',
+                                   default=[],
+                                   help='import the newest uploaded image '
+                                        'of every ROLE (e.g. suac)'
+                                   )
+        self._add_journal_args(parser_import)
+
+        # Create parser for verify command.
+        verify_help = """Check images in downloaded directory against
+                    its %s manifest using all CPU cores.
+                    """ % SUMS_FILE
+        parser_verify = subparsers.add_parser('verify', help=verify_help)
+        parser_verify.set_defaults(command='verify')
+        parser_verify.add_argument('DIR',
+                                   nargs='?',
+                                   default='.',
+                                   help='directory with images and %s '
+                                        '(default: current)' % SUMS_FILE
+                                   )
+
+        # Create parser for test command.
+        test_help = """Start imported virtual machines headless and
+                    run pytest suites in all of them at once through
+                    guest control. Suites are paths relative to ~/git
+                    which is shared with every VM. Results are merged
+                    into one JUnit report.
+                    """
+        parser_test = subparsers.add_parser('test', help=test_help)
+        parser_test.set_defaults(command='test')
+        parser_test.add_argument('VM_NAME',
+                                 nargs='+',
+                                 help='imported virtual machine name'
+                                 )
+        parser_test.add_argument('-s', '--suite',
+                                 action='append',
+                                 required=True,
+                                 help='test suite path relative to ~/git '
+                                      '(may be repeated)'
+                                 )
+        parser_test.add_argument('-o', '--output',
+                                 default='junit.xml',
+                                 help='merged JUnit report '
+                                      '(default: %(default)s)'
+                                 )
+        parser_test.add_argument('--keep-running',
+                                 action='store_true',
+                                 help="don't power off VMs after tests"
+                                 )
         self.args = self.parser.parse_args()
+        if not hasattr(self.args, 'command'):
+            self.parser.error('subcommand is required')
+        if (self.args.command == 'import' and not self.args.NAME and
+                not self.args.latest and not self._resuming()):
+            parser_import.error('NAME or --latest is required')
+        # Journal of previous batch defines VMs to handle.
+        if self.args.command == 'build' and self._resuming() and \
+                self.args.VM_NAME:
+            parser_build.error('VM_NAME is not allowed with --resume '
+                               'or --retry-failed')
+        if self.args.command == 'import' and self._resuming() and \
+                (self.args.NAME or self.args.latest):
+            parser_import.error('NAME and --latest are not allowed with '
+                                '--resume or --retry-failed')
+        # Journal of the running build or import batch.
+        self.journal = None
+        # Background mail sender of build command.
+        self.notifier = None
 
     @staticmethod
     def _discover_templates():
@@ -455,32 +1543,79 @@ class Interface:
         given then call self._discover to determine the list of VMs
         from existing Packer templates.
         """
-        if self.args.VM_NAME:
-            bld = Builder(self.args.VM_NAME)
+        journal = Journal(os.path.join(paths.journal, 'build.json'))
+        self.journal = journal
+        if self.args.mail:
+            # Start the sender now so the mail is sent while the rest
+            # of the run is finished. See _close_notifier().
+            self.notifier = Notifier()
+        if self._resuming():
+            vms = self._select(journal)
         else:
-            bld = Builder(self._discover_templates())
+            vms = self.args.VM_NAME or self._discover_templates()
+            journal.start(vms)
+        bld = Builder(vms, journal=journal, compact=self.args.compact)
         bld.build()
-        result = bld.upload()
+        retry = self._failed(journal)
+        while retry:
+            bld.vmlist = retry
+            bld.build()
+            retry = self._failed(journal)
+        if not bld.results:
+            print("Nothing to upload", file=stderr)
+            return None
+        if self.args.compact:
+            bld.compact_report()
+        compress = self.args.zstd or self.args.zstd_only
+        result = bld.upload(compress=compress,
+                            keep_raw=not self.args.zstd_only,
+                            level=self.args.level,
+                            threads=self.args.threads)
         # Send mail only if asked and Builder.upload() return
         # not empty 'uploaded' list.
-        if self.args.mail and result[1]:
-            bld.mail(result[0])
+        if self.notifier is not None and result[1]:
+            bld.mail(result[0], self.notifier)
         return result
 
+    def _close_notifier(self):
+        """Wait for mail delivery. Return number of undelivered."""
+        if self.notifier is None:
+            return 0
+        if not self.notifier.close(timeout=MAIL_TIMEOUT):
+            print("Mail is not sent in {} s. Giving up.".format(
+                MAIL_TIMEOUT), file=stderr)
+        undelivered = self.notifier.undelivered()
+        if undelivered:
+            print("{} mail message(s) NOT delivered".format(undelivered),
+                  file=stderr)
+        return undelivered
+
     @staticmethod
-    def _ova_from_dir(directory):
-        """Retrieve list of .ova from dir. Return list."""
+    def _is_image(name):
+        """Check if name looks like plain or compressed OVA."""
+        return name.endswith('.ova') or name.endswith('.ova' + ZSTD_SUFFIX)
+
+    def _ova_from_dir(self, directory):
+        """Retrieve list of .ova from dir. Return list.
+
+        Compressed image is skipped if uncompressed one is near.
+        """
         res = []
-        for file in os.listdir(directory):
-            if file.endswith('.ova'):
-                res.append(os.path.join(directory, file))
+        files = os.listdir(directory)
+        for file in files:
+            if not self._is_image(file):
+                continue
+            plain = file[:-len(ZSTD_SUFFIX)]
+            if file.endswith(ZSTD_SUFFIX) and plain in files:
+                continue
+            res.append(os.path.join(directory, file))
         return res
 
     def _prepare_ovas(self):
         """Get list of .ova from self.args. Return list."""
-        ovalist = []
+        ovalist = latest_images(self.args.latest, paths.upload)
         for name in self.args.NAME:
-            if name.endswith('.ova'):
+            if self._is_image(name):
                 ovalist.append(name)
             elif os.path.isdir(name):
                 ovalist.extend(self._ova_from_dir(name))
@@ -495,15 +1630,113 @@ class Interface:
             myfunc = force_import
         else:
             myfunc = just_import
-        ovas = self._prepare_ovas()
+        journal = Journal(os.path.join(paths.journal, 'import.json'))
+        self.journal = journal
+        if self._resuming():
+            ovas = self._select(journal)
+        else:
+            ovas = self._prepare_ovas()
+            journal.start(ovas)
         if len(ovas) > 0:
-            imprt = Importer(ovas)
-            result = imprt.vmimport(func=myfunc)
+            imprt = Importer(ovas, journal=journal)
+            result = imprt.vmimport(func=myfunc, stale=self._stale(journal))
+            retry = self._failed(journal)
+            while retry:
+                imprt.vmlist = retry
+                result = imprt.vmimport(func=myfunc,
+                                        stale=self._stale(journal))
+                retry = self._failed(journal)
         else:
             print("No images found in %s" % self.args.NAME, file=stderr)
             result = None
         return result
 
+    def _resuming(self):
+        """Check if previous batch should be continued."""
+        return self.args.resume or self.args.retry_failed
+
+    def _select(self, journal):
+        """Get sources to handle from journal of previous batch.
+
+        With --resume take VMs which were not handled yet. With
+        --retry-failed take failed VMs having attempts left.
+        """
+        states = []
+        if self.args.resume:
+            states.extend([Journal.QUEUED, Journal.RUNNING])
+        if self.args.retry_failed:
+            states.append(Journal.FAILED)
+        print(journal)
+        return journal.select(*states, max_attempts=self.args.max_attempts)
+
+    def _batch_failed(self):
+        """Report VMs failed in the batch. Return their number."""
+        failed = self.journal.select(Journal.FAILED)
+        if failed:
+            print("{0} VM(s) failed: {1}".format(len(failed),
+                                                 ' '.join(failed)),
+                  file=stderr)
+        return len(failed)
+
+    @staticmethod
+    def _stale(journal):
+        """Get names of VMs whose import was interrupted or failed."""
+        return [vm_name(source) for source
+                in journal.select(Journal.RUNNING, Journal.FAILED)]
+
+    def _failed(self, journal):
+        """Get failed VMs to retry. Return list."""
+        if not self.args.retry_failed:
+            return []
+        return journal.select(Journal.FAILED,
+                              max_attempts=self.args.max_attempts)
+
+    @staticmethod
+    def _add_journal_args(parser):
+        """Add options for resuming batch from its journal."""
+        parser.add_argument('--resume',
+                            action='store_true',
+                            help='continue previous run, handle VMs '
+                                 'which were not handled yet'
+                            )
+        parser.add_argument('--retry-failed',
+                            action='store_true',
+                            help='rerun only VMs failed in previous run'
+                            )
+        parser.add_argument('--max-attempts',
+                            type=int,
+                            default=3,
+                            help='max attempts per VM with --retry-failed '
+                                 '(default: %(default)s)'
+                            )
+
+    def _verify(self):
+        """Verify images in self.args.DIR. Return number of failed.
+
+        Missing or unreadable manifest counts as one failure.
+        """
+        try:
+            failed = verify_sums(self.args.DIR)
+        except (OSError, ValueError) as exc:
+            print("Can't read {0} in {1}: {2}".format(SUMS_FILE,
+                                                      self.args.DIR, exc),
+                  file=stderr)
+            return 1
+        if failed:
+            print("{} image(s) did NOT match".format(len(failed)),
+                  file=stderr)
+        return len(failed)
+
+    def _test(self):
+        """Run suites in VMs. Return number of failures."""
+        tester = Tester(self.args.VM_NAME, threads=len(self.args.VM_NAME))
+        totals = tester.test(self.args.suite, self.args.output,
+                             self.args.keep_running)
+        print("{tests} tests, {failures} failures, {errors} errors, "
+              "{skipped} skipped, {vms_failed} VMs failed".format(**totals))
+        print("JUnit report: {}".format(self.args.output))
+        return totals['failures'] + totals['errors'] + totals['vms_failed']
+
     def main(self):
         """Perform actions according to the given command and options.
 
@@ -516,13 +1749,34 @@ class Interface:
         Expect at least one argument. If it is directory then all
         images from that directory will be exported. If it is image
         or list of images then it will import all of it.
+
+        Build and import commands return non-zero exit status if any
+        VM of the batch is left failed in the journal.
+
+        Test command:
+        Run given suites in given VMs. Return non-zero exit status
+        if any test or VM failed.
+
+        Verify command:
+        Check images in given directory against its SHA256SUMS.
+        Return non-zero exit status if any image failed.
         """
-        if hasattr(self.args, 'VM_NAME'):
-            self._build()
-        else:
+        if self.args.command == 'test':
+            return 1 if self._test() else 0
+        elif self.args.command == 'build':
+            try:
+                self._build()
+            finally:
+                self._close_notifier()
+            return 1 if self._batch_failed() else 0
+        elif self.args.command == 'import':
             self._import()
+            return 1 if self._batch_failed() else 0
+        elif self.args.command == 'verify':
+            return 1 if self._verify() else 0
+        return 0
 
 
 if __name__ == '__main__':
     iface = Interface()
-    iface.main()
+    raise SystemExit(iface.main())
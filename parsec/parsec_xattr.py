@@ -0,0 +1,190 @@
+"""In-process reader of parsec MAC labels and audit flags.
+
+Labels and audit flags are read from file extended attributes with
+os.getxattr() and decoded into MacLabel and AuditFlags objects, so no
+process is spawned per check. If an attribute can't be read or
+decoded the CLI tools (pdp-ls, getfaud) are used instead.
+
+Binary layouts are declared in MAC_FORMAT, MAC_FLAGS, AUDIT_FORMAT and
+AUDIT_FLAGS. They are NOT checked against a real parsec attribute
+dump yet: a value of the expected length in another layout decodes
+to wrong label silently. Until a 'getfattr -e hex' vector from parsec
+host is added to test_parsec_xattr.py, check results against pdp-ls
+and getfaud (test_fs_xattrs.py uses the CLI tools for that reason).
+"""
+
+import os
+import re
+import errno
+import struct
+from collections import namedtuple
+from subprocess import Popen, PIPE
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+MAC_XATTR = 'security.PDPL'
+AUDIT_XATTR = 'security.AUDIT'
+
+# Level, integrity level, flags, categories (little-endian).
+MAC_FORMAT = '<BBHQ'
+MAC_FLAGS = [
+    ('ccnr', 0x1),
+    ('ehole', 0x2),
+    ('whole', 0x4),
+    ('ccnri', 0x8)
+]
+
+# Success and fail event masks (little-endian).
+AUDIT_FORMAT = '<II'
+# Audit event letters, bit 0 first.
+AUDIT_FLAGS = 'oxducmrnyapht'
+
+# Errors meaning the attribute is absent or unsupported.
+_NO_XATTR = (errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+class MacLabel(namedtuple('MacLabel', 'level ilev cats flags')):
+    """MAC label: level, integrity level, categories and flag names.
+
+    str() gives the same 'level:ilev:cats:flags' form as pdp-ls -Mn.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Decode extended attribute value. Return MacLabel."""
+        size = struct.calcsize(MAC_FORMAT)
+        # Any other length means the layout differs from MAC_FORMAT.
+        if len(blob) != size:
+            raise ValueError("MAC label is {0} bytes, expected {1}".format(
+                len(blob), size))
+        level, ilev, flags, cats = struct.unpack(MAC_FORMAT, blob)
+        names = tuple(name for name, bit in MAC_FLAGS if flags & bit)
+        return cls(level, ilev, cats, names)
+
+    def to_bytes(self):
+        """Encode label as extended attribute value. Return bytes."""
+        flags = 0
+        for name, bit in MAC_FLAGS:
+            if name in self.flags:
+                flags |= bit
+        return struct.pack(MAC_FORMAT, self.level, self.ilev, flags,
+                           self.cats)
+
+    @classmethod
+    def parse(cls, text):
+        """Parse 'level:ilev:cats:flags' from pdp-ls output.
+
+        Return MacLabel or None if no label found.
+        """
+        match = re.search(r'\b(\d+):(\d+):(0x[0-9a-fA-F]+|\d+):([\w,]+)',
+                          text)
+        if not match:
+            return None
+        level, ilev, cats, flags = match.groups()
+        try:
+            # Numeric flags field, e.g. '0' or '0x0'.
+            mask = int(flags, 0)
+        except ValueError:
+            names = tuple(flags.split(','))
+        else:
+            names = tuple(name for name, bit in MAC_FLAGS if mask & bit)
+        return cls(int(level), int(ilev), int(cats, 0), names)
+
+    def __str__(self):
+        flags = ','.join(self.flags) if self.flags else '0'
+        return "{0}:{1}:{2}:{3}".format(self.level, self.ilev, self.cats,
+                                        flags)
+
+
+class AuditFlags(namedtuple('AuditFlags', 'success fail')):
+    """Audit flags: letters of audited events on success and fail.
+
+    str() gives 'success:fail' as accepted by setfaud -m.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def _letters(mask):
+        return ''.join(l for i, l in enumerate(AUDIT_FLAGS) if mask >> i & 1)
+
+    @staticmethod
+    def _mask(letters):
+        mask = 0
+        for letter in letters:
+            mask |= 1 << AUDIT_FLAGS.index(letter)
+        return mask
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Decode extended attribute value. Return AuditFlags."""
+        size = struct.calcsize(AUDIT_FORMAT)
+        if len(blob) != size:
+            raise ValueError("Audit flags are {0} bytes, expected {1}".format(
+                len(blob), size))
+        success, fail = struct.unpack(AUDIT_FORMAT, blob)
+        return cls(cls._letters(success), cls._letters(fail))
+
+    def to_bytes(self):
+        """Encode flags as extended attribute value. Return bytes."""
+        return struct.pack(AUDIT_FORMAT, self._mask(self.success),
+                           self._mask(self.fail))
+
+    @classmethod
+    def parse(cls, text):
+        """Parse 'success:fail' from the last field of getfaud output.
+
+        Return AuditFlags or None if no flags found. getfaud prints
+        three fields for flags set with 'setfaud -m o:o' ('o:o:o') and
+        which two of them are success and fail isn't known, so such
+        output is not decoded (None is returned).
+        """
+        match = re.search(r'(?:^|\s)([a-z-]*):([a-z-]*)\s*$', text.strip())
+        if not match:
+            return None
+        success, fail = (f.replace('-', '') for f in match.groups())
+        return cls(success, fail)
+
+    def __str__(self):
+        return "{0}:{1}".format(self.success or '-', self.fail or '-')
+
+
+def _run(cmd):
+    """Run command. Return its stdout as str."""
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    output = proc.communicate()
+    return output[0].decode()
+
+
+def _read(path, attr, decoder, cmd, fallback):
+    """Read and decode attr of path, use cmd if it fails."""
+    try:
+        return decoder.from_bytes(os.getxattr(path, attr))
+    except OSError as exc:
+        if not fallback or exc.errno not in _NO_XATTR:
+            raise
+    except ValueError:
+        if not fallback:
+            raise
+    return decoder.parse(_run(cmd + [path]))
+
+
+def get_label(path, fallback=True, attr=MAC_XATTR):
+    """Get MAC label of path. Return MacLabel or None.
+
+    If fallback is True and attribute can't be read then pdp-ls
+    output is parsed instead.
+    """
+    return _read(path, attr, MacLabel, ['pdp-ls', '-Mn'], fallback)
+
+
+def get_audit(path, fallback=True, attr=AUDIT_XATTR):
+    """Get audit flags of path. Return AuditFlags or None.
+
+    If fallback is True and attribute can't be read then getfaud
+    output is parsed instead.
+    """
+    return _read(path, attr, AuditFlags, ['getfaud'], fallback)
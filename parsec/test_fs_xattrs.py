@@ -2,11 +2,14 @@ import pytest
 import shlex
 import os
 import re
-from subprocess import Popen, PIPE, call
+import shutil
+import tempfile
+from collections import namedtuple
+from subprocess import Popen, PIPE, call, check_call, check_output
 
 
 __author__ = 'vgol'
-__version__ = '0.2.0'
+__version__ = '0.5.0'
 
 
 # Test data.
@@ -32,7 +35,10 @@ audit_xfail = [
     'minix',
     'exfat'
 ]
-tfile = '/mnt/testfile'
+
+# Image of running test attached to its own loop device and
+# mounted to its own directory, so tests can run in parallel.
+MountedImage = namedtuple('MountedImage', 'image device mnt tfile')
 
 # System configuration pseudo FS list.
 pseudo_fs_sysconf = [
@@ -59,36 +65,81 @@ pseudo_fs_writable = [
 ]
 
 
+class GoldenImages:
+    """Cache of pristine formatted images, one per FS type.
+
+    Images are created as sparse files in directory on first request
+    and formatted only once per session.
+    """
+    img_size = 2000000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.images = {}
+
+    def get(self, fs):
+        """Return path to pristine image with fs."""
+        if fs not in self.images:
+            image = os.path.join(self.directory, 'golden-' + fs)
+            with open(image, 'wb') as img:
+                img.truncate(self.img_size)
+            if re.match('(ext[2-4]|ntfs)', fs):
+                _create_img_default(fs, image)
+            else:
+                _create_img_simple(fs, image)
+            self.images[fs] = image
+        return self.images[fs]
+
+
+@pytest.fixture(scope='session')
+def golden_images(request):
+    """Provide GoldenImages cache for the whole session."""
+    directory = tempfile.mkdtemp(prefix='golden-', dir='/tmp')
+
+    def cleaning():
+        shutil.rmtree(directory)
+
+    request.addfinalizer(cleaning)
+    return GoldenImages(directory)
+
+
 @pytest.fixture(
     scope='function',
     params=fs_types
 )
-def preparefs(request):
-    """Create image with FS. Return path as str."""
-    image = os.path.join('/tmp', 'image-' + request.param)
-    img_size = 2000000
-    with open(image, 'wb') as img, open('/dev/zero', 'rb') as zero:
-        img.write(zero.read(img_size))
-    if re.match('(ext[2-4]|ntfs)', request.param):
-        _create_img_default(request.param, image)
-    else:
-        _create_img_simple(request.param, image)
+def preparefs(request, golden_images):
+    """Copy pristine image with FS and mount it. Return MountedImage.
+
+    Every test gets its own directory, loop device and mount point.
+    """
+    workdir = tempfile.mkdtemp(prefix='parsec-', dir='/tmp')
+    image = os.path.join(workdir, 'image-' + request.param)
+    mnt = os.path.join(workdir, 'mnt')
+    os.mkdir(mnt)
+    # Reflink copy if FS supports it, sparse copy otherwise.
+    check_call(['cp', '--reflink=auto', '--sparse=always',
+                golden_images.get(request.param), image])
+    device = check_output(['losetup', '--find', '--show', image])
+    mounted = MountedImage(image, device.decode().strip(), mnt,
+                           os.path.join(mnt, 'testfile'))
+    _mount_img(mounted)
 
     def cleaning():
-        call(['umount', image])
-        os.remove(image)
+        call(['umount', mnt])
+        call(['losetup', '-d', mounted.device])
+        shutil.rmtree(workdir)
 
     request.addfinalizer(cleaning)
-    return image
+    return mounted
 
 
 @pytest.fixture(scope='function')
-def set_mount_point_label(request):
+def set_mount_point_label(request, preparefs):
     """Set label to mount point. And return as was"""
-    call(shlex.split("pdpl-file 1:0:0:ccnr /mnt"))
+    call(['pdpl-file', '1:0:0:ccnr', preparefs.mnt])
 
     def lbl_back():
-        call(shlex.split("pdpl-file 0:0:0:0 /mnt"))
+        call(['pdpl-file', '0:0:0:0', preparefs.mnt])
 
     request.addfinalizer(lbl_back)
 
@@ -106,8 +157,6 @@ def _create_img_default(fs, img):
     """
     mkfs = "/sbin/mkfs.{0} -F {1}".format(fs, img)
     call(shlex.split(mkfs))
-    mount = "mount -o loop {img} /mnt".format(img=img)
-    call(shlex.split(mount))
 
 
 def _create_img_simple(fs, img):
@@ -117,14 +166,12 @@ def _create_img_simple(fs, img):
     """
     mkfs = "/sbin/mkfs.{0} {1}".format(fs, img)
     call(shlex.split(mkfs))
-    mount = "mount -o loop {img} /mnt".format(img=img)
-    call(shlex.split(mount))
 
 
-def _mount_img(image):
-    """Mount img to /mnt. Return tuple of bytes."""
-    mount_image = "mount -o loop {img} /mnt".format(img=image)
-    mnt = Popen(shlex.split(mount_image), stdout=PIPE, stderr=PIPE)
+def _mount_img(mounted):
+    """Mount loop device of MountedImage. Return tuple of bytes."""
+    mount_image = ['mount', mounted.device, mounted.mnt]
+    mnt = Popen(mount_image, stdout=PIPE, stderr=PIPE)
     output = mnt.communicate()
     return output
 
@@ -152,6 +199,7 @@ def _fs_from_image(img):
 
 def test_read_write(preparefs):
     """Try to read and write into image."""
+    tfile = preparefs.tfile
     # Try to write.
     with open(tfile, 'wb') as tf:
         tf.write(b'this is test')
@@ -165,8 +213,9 @@ def test_read_write(preparefs):
 def test_mac(preparefs, set_mount_point_label):
     """Check MAC attributes."""
     # Mark as expected fail for no xattr fs.
-    if _fs_from_image(preparefs) in mac_xfail:
+    if _fs_from_image(preparefs.image) in mac_xfail:
         pytest.xfail('xattrs not supported')
+    tfile = preparefs.tfile
     with open(tfile, 'wb') as tf:
         tf.write(b'this is secret')
     assert os.path.exists(tfile)
@@ -174,7 +223,7 @@ def test_mac(preparefs, set_mount_point_label):
     lbl = _get_label(tfile)
     assert '1:0:0:0' in lbl
     call('sync')
-    call(['umount', '/mnt'])
+    call(['umount', preparefs.mnt])
     mount_result = _mount_img(preparefs)
     assert not mount_result[1], mount_result[1].decode()
     lbl = _get_label(tfile)
@@ -185,8 +234,9 @@ def test_mac(preparefs, set_mount_point_label):
 def test_audit(preparefs):
     """Check audit flags."""
     # Mark as expected fail for no xattr fs.
-    if _fs_from_image(preparefs) in audit_xfail:
+    if _fs_from_image(preparefs.image) in audit_xfail:
         pytest.xfail('xattrs not supported')
+    tfile = preparefs.tfile
     with open(tfile, 'wb') as tf:
         tf.write(b'this is for test')
     assert os.path.exists(tfile)
@@ -194,7 +244,7 @@ def test_audit(preparefs):
     lbl = _get_aud(tfile)
     assert 'o:o:o' in lbl
     call('sync')
-    call(['umount', '/mnt'])
+    call(['umount', preparefs.mnt])
     mount_result = _mount_img(preparefs)
     assert not mount_result[1], mount_result[1].decode()
     lbl = _get_aud(tfile)
@@ -0,0 +1,134 @@
+"""Unit tests for parsec_xattr. Run on plain Linux without parsec."""
+
+import errno
+import pytest
+import parsec_xattr
+from parsec_xattr import MacLabel, AuditFlags
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+@pytest.fixture(scope='function')
+def fake_xattrs(monkeypatch):
+    """Replace os.getxattr with dict lookup. Return the dict."""
+    xattrs = {}
+
+    def getxattr(path, attr):
+        try:
+            return xattrs[path, attr]
+        except KeyError:
+            raise OSError(errno.ENODATA, 'No data available', path)
+
+    monkeypatch.setattr(parsec_xattr.os, 'getxattr', getxattr)
+    return xattrs
+
+
+@pytest.fixture(scope='function')
+def fake_cli(monkeypatch):
+    """Replace CLI tools runner. Return the list of commands run."""
+    outputs = {
+        'pdp-ls': "-rw-r--r-- 1 u u 2:0:0x3:ccnr /tmp/f\n",
+        'getfaud': "/tmp/f: o:ox\n"
+    }
+    calls = []
+
+    def run(cmd):
+        calls.append(cmd)
+        return outputs[cmd[0]]
+
+    monkeypatch.setattr(parsec_xattr, '_run', run)
+    return calls
+
+
+@pytest.mark.parametrize('label', [
+    MacLabel(0, 0, 0, ()),
+    MacLabel(1, 0, 0, ()),
+    MacLabel(3, 1, 0xff, ('ccnr',)),
+    MacLabel(2, 0, 1 << 63, ('ehole', 'whole'))
+])
+def test_label_roundtrip(label):
+    """Encoded label must decode to the same label."""
+    assert MacLabel.from_bytes(label.to_bytes()) == label
+
+
+def test_label_str():
+    """Label looks like pdp-ls -Mn output."""
+    assert str(MacLabel(1, 0, 0, ())) == '1:0:0:0'
+    assert str(MacLabel(1, 0, 0, ('ccnr',))) == '1:0:0:ccnr'
+
+
+@pytest.mark.parametrize('blob', [b'\x01', bytes(13)])
+def test_label_wrong_length(blob):
+    """Blob of any other length is not decoded."""
+    with pytest.raises(ValueError):
+        MacLabel.from_bytes(blob)
+
+
+@pytest.mark.parametrize('blob', [bytes(4), bytes(12)])
+def test_audit_wrong_length(blob):
+    with pytest.raises(ValueError):
+        AuditFlags.from_bytes(blob)
+
+
+@pytest.mark.parametrize('flags', [
+    AuditFlags('', ''),
+    AuditFlags('o', 'o'),
+    AuditFlags('ox', 'd')
+])
+def test_audit_roundtrip(flags):
+    """Encoded audit flags must decode to the same flags."""
+    assert AuditFlags.from_bytes(flags.to_bytes()) == flags
+
+
+def test_get_label_from_xattr(fake_xattrs, fake_cli):
+    fake_xattrs['/tmp/f', parsec_xattr.MAC_XATTR] = \
+        MacLabel(1, 0, 0, ()).to_bytes()
+    assert parsec_xattr.get_label('/tmp/f') == MacLabel(1, 0, 0, ())
+    assert not fake_cli
+
+
+def test_get_audit_from_xattr(fake_xattrs, fake_cli):
+    fake_xattrs['/tmp/f', parsec_xattr.AUDIT_XATTR] = \
+        AuditFlags('o', 'o').to_bytes()
+    assert parsec_xattr.get_audit('/tmp/f') == AuditFlags('o', 'o')
+    assert not fake_cli
+
+
+def test_fallback_to_cli(fake_xattrs, fake_cli):
+    """Missing xattrs are read through CLI tools."""
+    assert parsec_xattr.get_label('/tmp/f') == MacLabel(2, 0, 3, ('ccnr',))
+    assert parsec_xattr.get_audit('/tmp/f') == AuditFlags('o', 'ox')
+    assert [c[0] for c in fake_cli] == ['pdp-ls', 'getfaud']
+
+
+def test_wrong_layout_fallback(fake_xattrs, fake_cli):
+    """Values of unexpected length are read through CLI tools."""
+    fake_xattrs['/tmp/f', parsec_xattr.MAC_XATTR] = bytes(16)
+    fake_xattrs['/tmp/f', parsec_xattr.AUDIT_XATTR] = bytes(12)
+    assert parsec_xattr.get_label('/tmp/f') == MacLabel(2, 0, 3, ('ccnr',))
+    assert parsec_xattr.get_audit('/tmp/f') == AuditFlags('o', 'ox')
+    assert [c[0] for c in fake_cli] == ['pdp-ls', 'getfaud']
+
+
+@pytest.mark.parametrize('text, label', [
+    ("2:0:0x3:ccnr /tmp/f", MacLabel(2, 0, 3, ('ccnr',))),
+    ("1:0:0:0x0 /tmp/f", MacLabel(1, 0, 0, ())),
+    ("1:0:0:0x5 /tmp/f", MacLabel(1, 0, 0, ('ccnr', 'whole')))
+])
+def test_label_parse(text, label):
+    """Numeric flags field is a mask, not a flag name."""
+    assert MacLabel.parse(text) == label
+
+
+def test_audit_parse_three_fields():
+    """Three-field getfaud output is not guessed into two fields."""
+    assert AuditFlags.parse("/tmp/f: o:ox") == AuditFlags('o', 'ox')
+    assert AuditFlags.parse("/tmp/f: o:o:o") is None
+
+
+def test_no_fallback(fake_xattrs, fake_cli):
+    with pytest.raises(OSError):
+        parsec_xattr.get_label('/tmp/f', fallback=False)
+    assert not fake_cli
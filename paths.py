@@ -4,7 +4,8 @@ packer - absolute path to Packer directory;
 packer_templates - absolute path to Packer templates directory;
 packer_export - relative (from template dir) path to exported VM;
 vm_group - testing VM group;
-upload - where to put exported VMs.
+upload - where to put exported VMs;
+journal - where to keep journals of build and import batches.
 """
 
 
@@ -20,3 +21,4 @@ packer_templates = join(packer, "templates")
 packer_export = "export"
 vm_group = "smolensk_unstable"
 upload = "/home/ftp/vm"
+journal = join(packer, "journal")
@@ -0,0 +1,486 @@
+"""Tests for createvm.py using fake VBoxManage."""
+
+import io
+import os
+import errno
+import sys
+import stat
+import tarfile
+import socketserver
+import threading
+import pytest
+import xml.etree.ElementTree as ElementTree
+import createvm
+
+
+__author__ = 'vgol'
+__version__ = '0.1.0'
+
+
+# Fake VBoxManage. Guest file system is FAKE_GUEST directory. pytest
+# run in a guest whose name contains 'bad' has a failed test, VM
+# named 'dead' never boots. Every VM has FAKE_GUEST/disk.vdi disk,
+# compaction halves it.
+FAKE_VBOXMANAGE = '''#!{python}
+import os
+import sys
+
+guest = os.environ['FAKE_GUEST']
+args = sys.argv[1:]
+if args[0] in ('startvm', 'controlvm', 'unregistervm'):
+    sys.exit(0)
+if args[0] == 'showvminfo':
+    print('name="%s"' % args[1])
+    print('"SATA Controller-0-0"="%s/disk.vdi"' % guest)
+    sys.exit(0)
+if args[0] == 'modifymedium' and args[-1] == '--compact':
+    os.truncate(args[2], os.path.getsize(args[2]) // 2)
+    sys.exit(0)
+if args[0] == 'export':
+    with open(args[args.index('--output') + 1], 'w') as fobj:
+        fobj.write(' '.join(args))
+    sys.exit(0)
+if args[0] == 'guestcontrol':
+    vm = args[1]
+    cmd = args[args.index('--') + 1:]
+    if vm == 'dead':
+        sys.exit(1)
+    if cmd[0] == '/bin/true':
+        sys.exit(0)
+    if cmd[0] == '/bin/cat':
+        with open(guest + cmd[1]) as fobj:
+            sys.stdout.write(fobj.read())
+        sys.exit(0)
+    if cmd[0] == '/bin/bash':
+        junit = cmd[2].split('--junitxml=')[1].split()[0]
+        failures = 1 if 'bad' in vm else 0
+        print('collected 2 items')
+        os.makedirs(os.path.dirname(guest + junit), exist_ok=True)
+        with open(guest + junit, 'w') as fobj:
+            fobj.write('<testsuites><testsuite name="pytest" tests="2" '
+                       'failures="%d" errors="0" skipped="0">'
+                       '<testcase classname="test_fs" name="test_a"/>'
+                       '<testcase classname="test_fs" name="test_b"/>'
+                       '</testsuite></testsuites>' % failures)
+        sys.exit(failures)
+sys.exit(2)
+'''
+
+
+@pytest.fixture(scope='function')
+def fake_vbox(tmpdir, monkeypatch):
+    """Put fake VBoxManage first in PATH. Return guest root."""
+    bindir = tmpdir.mkdir('bin')
+    vbox = bindir.join('VBoxManage')
+    vbox.write(FAKE_VBOXMANAGE.format(python=sys.executable))
+    os.chmod(str(vbox), stat.S_IRWXU)
+    guest = tmpdir.mkdir('guest')
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKE_GUEST', str(guest))
+    monkeypatch.setattr(createvm, 'GUEST_BOOT_TIMEOUT', 0)
+    return guest
+
+
+def test_tester_merges_reports(fake_vbox, tmpdir, capfd):
+    output = str(tmpdir.join('junit.xml'))
+    tester = createvm.Tester(['suac', 'sufs-bad'], threads=2)
+    totals = tester.test(['smol-auto/parsec'], output)
+    assert totals == {'tests': 4, 'failures': 1, 'errors': 0,
+                      'skipped': 0, 'vms_failed': 0}
+    root = ElementTree.parse(output).getroot()
+    names = sorted(suite.get('name') for suite in root)
+    assert names == ['suac.pytest', 'sufs-bad.pytest']
+    classes = {case.get('classname') for case in root.iter('testcase')}
+    assert classes == {'suac.test_fs', 'sufs-bad.test_fs'}
+    out = capfd.readouterr()[0]
+    assert '[suac] collected 2 items' in out
+    assert '[sufs-bad] collected 2 items' in out
+
+
+def test_tester_vm_not_booted(fake_vbox, tmpdir):
+    output = str(tmpdir.join('junit.xml'))
+    tester = createvm.Tester(['suac', 'dead'], threads=2)
+    totals = tester.test(['smol-auto/parsec'], output)
+    assert totals['tests'] == 2
+    assert totals['vms_failed'] == 1
+
+
+def test_import_failure_raises(fake_vbox, tmpdir):
+    """Failed VBoxManage import is an error, not a skipped VM."""
+    ova = tmpdir.join('suac.ova')
+    ova.write('image')
+    # Constructor requires installed VirtualBox.
+    v_machine = object.__new__(createvm.VirtualMachine)
+    v_machine.name = 'suac'
+    with pytest.raises(createvm.subprocess.CalledProcessError):
+        v_machine.importvm(str(ova))
+
+
+def test_stale_vm_is_reimported(monkeypatch):
+    """VM left by interrupted attempt is not skipped as existing."""
+    forced = []
+    monkeypatch.setattr(createvm, 'force_import',
+                        lambda ova, stale=(): forced.append(ova) or 'suac')
+    assert createvm.just_import('/upload/suac.ova', ['suac']) == 'suac'
+    assert forced == ['/upload/suac.ova']
+
+
+def test_upload_index(tmpdir):
+    """Newest image of role is found by date, not by directory name."""
+    root = str(tmpdir)
+    for dirname in ['02-01-2026', '19-10-2025']:
+        upload_dir = tmpdir.mkdir(dirname)
+        upload_dir.join('suac.ova').write(dirname)
+        upload_dir.join('sufs.ova.zst').write(dirname)
+        createvm.write_sums(str(upload_dir))
+        createvm.update_index(str(upload_dir), root)
+    # Updating directory again must not duplicate versions.
+    createvm.update_index(str(tmpdir.join('02-01-2026')), root)
+    index = createvm.load_index(root)['roles']
+    assert [v['date'] for v in index['suac']] == ['2025-10-19', '2026-01-02']
+    assert createvm.latest_images(['suac', 'sufs'], root) == [
+        os.path.join(root, '02-01-2026', 'suac.ova'),
+        os.path.join(root, '02-01-2026', 'sufs.ova.zst')
+    ]
+
+
+def test_hash_files_cache(tmpdir, monkeypatch):
+    """Unchanged file is not hashed again."""
+    image = tmpdir.join('suac.ova')
+    image.write('image')
+    cache = {}
+    digests = createvm.hash_files([str(image)], cache=cache)
+    assert list(cache.values()) == list(digests.values())
+
+    def worker(path):
+        raise AssertionError("{} hashed again".format(path))
+
+    monkeypatch.setattr(createvm, '_sha256_worker', worker)
+    assert createvm.hash_files([str(image)], cache=cache) == digests
+
+
+def test_write_sums_prunes_cache(tmpdir):
+    """Cache entries of removed images are dropped."""
+    cache_file = str(tmpdir.join(createvm.DIGEST_CACHE))
+    old = tmpdir.mkdir('18-10-2026')
+    old.join('suac.ova').write('old image')
+    createvm.write_sums(str(old), cache_file)
+    new = tmpdir.mkdir('19-10-2026')
+    new.join('suac.ova').write('image')
+    createvm.write_sums(str(new), cache_file)
+    assert len(createvm.load_digest_cache(cache_file)) == 2
+    old.remove()
+    createvm.write_sums(str(new), cache_file)
+    assert list(createvm.load_digest_cache(cache_file)) \
+        == [createvm._cache_key(str(new.join('suac.ova')))]
+
+
+@pytest.mark.parametrize('sums', [None, 'garbage\n'])
+def test_verify_bad_manifest(tmpdir, monkeypatch, capfd, sums):
+    """Missing or broken manifest is an error, not a traceback."""
+    if sums is not None:
+        tmpdir.join(createvm.SUMS_FILE).write(sums)
+    monkeypatch.setattr(sys, 'argv', ['createvm.py', 'verify', str(tmpdir)])
+    # createvm binds stderr on import, before capfd is set up.
+    monkeypatch.setattr(createvm, 'stderr', sys.stderr)
+    assert createvm.Interface().main() == 1
+    assert createvm.SUMS_FILE in capfd.readouterr()[1]
+
+
+def test_journal(tmpdir):
+    """States survive reload, failed VMs are retried max_attempts times."""
+    path = str(tmpdir.join('journal', 'build.json'))
+    journal = createvm.Journal(path)
+    journal.start(['suac', 'sufs', '/upload/susrv.ova.zst'])
+    assert list(journal.entries) == ['suac', 'sufs', 'susrv']
+    journal.update('suac', createvm.Journal.RUNNING)
+    journal.update('suac', createvm.Journal.BUILT, result='suac.ova')
+    for attempt in range(2):
+        journal.update('sufs', createvm.Journal.RUNNING)
+        journal.update('sufs', createvm.Journal.FAILED, error='boom')
+    # Atomic save leaves no temporary file behind.
+    assert os.listdir(os.path.dirname(path)) == ['build.json']
+    journal = createvm.Journal(path)
+    assert journal.entries['sufs']['attempts'] == 2
+    assert journal.select(createvm.Journal.QUEUED) == ['/upload/susrv.ova.zst']
+    assert journal.select(createvm.Journal.FAILED, max_attempts=3) == ['sufs']
+    assert journal.select(createvm.Journal.FAILED, max_attempts=2) == []
+    assert journal.results(createvm.Journal.BUILT) == ['suac.ova']
+    assert str(journal) == \
+        "Journal {}: 1 built, 1 failed, 1 queued".format(path)
+    # Broken journal is treated as empty.
+    tmpdir.join('journal', 'build.json').write('{')
+    assert createvm.Journal(path).entries == {}
+
+
+@pytest.mark.parametrize('argv', [
+    ['build', '--resume', 'suac'],
+    ['import', '--retry-failed', 'suac.ova'],
+    ['import', '--resume', '--latest', 'suac']
+])
+def test_resume_rejects_names(monkeypatch, argv):
+    """Names can't be mixed with VMs taken from journal."""
+    monkeypatch.setattr(sys, 'argv', ['createvm.py'] + argv)
+    with pytest.raises(SystemExit) as exc:
+        createvm.Interface()
+    assert exc.value.code == 2
+
+
+def test_batch_failed_exit_status(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['createvm.py', 'build', '--resume'])
+    iface = createvm.Interface()
+    iface.journal = createvm.Journal(str(tmpdir.join('build.json')))
+    iface.journal.start(['suac', 'sufs'])
+    assert iface._batch_failed() == 0
+    iface.journal.update('sufs', createvm.Journal.FAILED)
+    assert iface._batch_failed() == 1
+
+
+def test_compactvm(fake_vbox, tmpdir):
+    """Disk is measured around compaction, VM exported with options."""
+    fake_vbox.join('disk.vdi').write('x' * 1000)
+    templ = tmpdir.mkdir('suac')
+    templ.join('suac.json').write(
+        '{"builders": [{"export_opts": ["--ovf20"]}]}')
+    templ.mkdir('export')
+    # Constructor requires installed VirtualBox.
+    v_machine = object.__new__(createvm.VirtualMachine)
+    v_machine.name = 'suac'
+    v_machine.dir = str(templ)
+    v_machine.template = 'suac.json'
+    ova = str(templ.join('export', 'suac.ova'))
+    assert v_machine.compactvm(ova) == (1000, 500)
+    assert open(ova).read().endswith('--output {} --ovf20'.format(ova))
+    bld = createvm.Builder([], threads=1)
+    bld.results = [ova, str(tmpdir.join('sufs.ova'))]
+    assert bld.compact_report() == [(ova, 1000, 500)]
+
+
+def _make_ova(path, members):
+    """Write tar with members {name: bytes}."""
+    with tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _read_ova(path):
+    """Read tar sequentially as VBoxManage does. Return dict."""
+    with tarfile.open(path, 'r|') as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar}
+
+
+def test_image_stream(tmpdir):
+    """Compressed OVA is served whole on every open of the pipe."""
+    ova = str(tmpdir.join('suac.ova'))
+    members = {'suac.ovf': b'<Envelope/>',
+               'suac-disk1.vmdk': os.urandom(256 * 1024)}
+    _make_ova(ova, members)
+    archive = createvm.compress_image(ova, level=1, threads=1)
+    assert archive == ova + createvm.ZSTD_SUFFIX
+    os.remove(ova)
+    with createvm.ImageStream(archive) as fifo:
+        assert os.path.basename(fifo) == 'suac.ova'
+        assert stat.S_ISFIFO(os.stat(fifo).st_mode)
+        assert _read_ova(fifo) == members
+        assert _read_ova(fifo) == members
+        # Reader giving up early doesn't block the end of stream.
+        with open(fifo, 'rb') as pipe:
+            pipe.read(10)
+    assert not os.path.exists(os.path.dirname(fifo))
+
+
+def test_sparse_copy(tmpdir):
+    """Holes are not transferred, data and logical size are kept."""
+    src = str(tmpdir.join('disk.vmdk'))
+    dst = str(tmpdir.join('copy.vmdk'))
+    size = 64 * 1024 * 1024
+    with open(src, 'wb') as fobj:
+        fobj.write(b'head')
+        fobj.seek(size // 2)
+        fobj.write(b'middle')
+        fobj.truncate(size)
+    transferred, logical = createvm.sparse_copy(src, dst)
+    assert logical == size
+    assert transferred < size
+    with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+        assert fsrc.read() == fdst.read()
+    assert os.stat(dst).st_blocks <= os.stat(src).st_blocks
+
+
+def _rename_exdev(monkeypatch):
+    """Make os.rename() fail like crossing file systems."""
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src, dst)
+    monkeypatch.setattr(os, 'rename', rename)
+
+
+def test_sparse_move_cross_fs(tmpdir, monkeypatch):
+    """Image is copied and source removed if rename crosses FS."""
+    src = tmpdir.join('suac.ova')
+    src.write_binary(b'image' * 1000)
+    dst = tmpdir.join('upload.ova')
+    _rename_exdev(monkeypatch)
+    assert createvm.sparse_move(str(src), str(dst)) == (5000, 5000)
+    assert not src.exists()
+    assert dst.read_binary() == b'image' * 1000
+
+
+def test_upload_cross_fs(tmpdir, monkeypatch, capsys):
+    """Builder.upload() publishes images from other file system."""
+    image = tmpdir.mkdir('build').join('suac.ova')
+    image.write('image')
+    monkeypatch.setattr(createvm.paths, 'upload',
+                        str(tmpdir.mkdir('upload')))
+    _rename_exdev(monkeypatch)
+    bld = createvm.Builder(['suac'])
+    bld.results = [str(image)]
+    upload_to, uploaded = bld.upload()
+    assert uploaded == ['suac.ova']
+    assert not image.exists()
+    assert open(os.path.join(upload_to, 'suac.ova')).read() == 'image'
+    assert 'suac.ova: 5 of 5 bytes transferred' in capsys.readouterr()[0]
+
+
+@pytest.mark.parametrize('copied', [0, 5])
+def test_copy_range_short_calls(tmpdir, monkeypatch, copied):
+    """Short copy_file_range() and write() don't lose data."""
+    data = bytes(range(256)) * 64
+    src = tmpdir.join('src')
+    src.write_binary(data)
+    dst = tmpdir.join('dst')
+    dst.write_binary(b'')
+    real_copy = getattr(os, 'copy_file_range', None)
+    real_write = os.write
+
+    def copy_file_range(fsrc, fdst, count):
+        return real_copy(fsrc, fdst, copied) if copied else 0
+
+    if real_copy is not None:
+        monkeypatch.setattr(os, 'copy_file_range', copy_file_range)
+    monkeypatch.setattr(os, 'write',
+                        lambda fd, buf: real_write(fd, buf[:1000]))
+    with open(str(src), 'rb') as fsrc, open(str(dst), 'r+b') as fdst:
+        createvm._copy_range(fsrc.fileno(), fdst.fileno(), 10, len(data) - 10)
+        with pytest.raises(OSError):
+            createvm._copy_range(fsrc.fileno(), fdst.fileno(), 0,
+                                 len(data) + 1)
+    assert dst.read_binary()[10:] == data[10:]
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server. First server.drop connections are closed."""
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        if server.drop > 0:
+            server.drop -= 1
+            return
+        self.reply('220 fake ESMTP')
+        data = None
+        for raw in self.rfile:
+            line = raw.decode().rstrip('\r\n')
+            if data is not None:
+                if line == '.':
+                    server.messages.append('\n'.join(data))
+                    data = None
+                    self.reply('250 queued')
+                else:
+                    data.append(line)
+            elif line.upper().startswith('DATA'):
+                data = []
+                self.reply('354 go ahead')
+            elif line.upper().startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture(scope='function')
+def smtp_server(request):
+    """Start fake SMTP server. Return it."""
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                             FakeSMTPHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.drop = 0
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(stop)
+    return server
+
+
+def test_notifier_reuses_connection(smtp_server):
+    notifier = createvm.Notifier('127.0.0.1', smtp_server.server_address[1])
+    for i in range(3):
+        notifier.send('a@b', ['c@d'], 'Subject: %d\n\nbody %d' % (i, i))
+    assert notifier.close(timeout=10)
+    assert notifier.sent == 3
+    assert notifier.undelivered() == 0
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 1
+
+
+def test_notifier_retries(smtp_server):
+    smtp_server.drop = 2
+    notifier = createvm.Notifier('127.0.0.1', smtp_server.server_address[1],
+                                 backoff=0.01)
+    notifier.send('a@b', ['c@d'], 'Subject: x\n\nbody')
+    assert notifier.close(timeout=10)
+    assert notifier.sent == 1
+    assert smtp_server.connections == 3
+
+
+def test_notifier_budget():
+    """Retries stop when the budget is spent, message is reported."""
+    with socketserver.TCPServer(('127.0.0.1', 0), None) as server:
+        port = server.server_address[1]
+    # Nothing listens on port now, every attempt is refused at once.
+    notifier = createvm.Notifier('127.0.0.1', port, retries=5, backoff=1,
+                                 budget=0.5)
+    notifier.send('a@b', ['c@d'], 'Subject: x\n\nbody')
+    assert notifier.close(timeout=5)
+    assert notifier.failed == 1
+    assert notifier.undelivered() == 1
+
+
+def test_builder_report(tmpdir):
+    upload_dir = tmpdir.mkdir('19-10-2026')
+    upload_dir.join('suac.ova').write('image')
+    createvm.write_sums(str(upload_dir))
+    bld = createvm.Builder(['suac', 'sufs'])
+    bld.durations = {'suac': 125}
+    rows = bld.report(str(upload_dir))
+    assert [(r['vm'], r['status'], r['size'], r['duration']) for r in rows] \
+        == [('suac', 'uploaded', 5, 125), ('sufs', 'failed', None, None)]
+    assert rows[0]['sha256'] is not None
+    text = createvm.Builder._format_report(rows)
+    assert '2m 05s' in text
+    assert text.splitlines()[0].split() == ['VM', 'Status', 'Size',
+                                            'Build', 'SHA256']
+
+
+def test_builder_report_failed_vm(tmpdir):
+    """Image uploaded earlier today isn't reported for failed VM."""
+    upload_dir = tmpdir.mkdir('19-10-2026')
+    for name in ['suac.ova', 'sufs.ova']:
+        upload_dir.join(name).write('image')
+    createvm.write_sums(str(upload_dir))
+    journal = createvm.Journal(str(tmpdir.join('build.json')))
+    journal.start(['suac', 'sufs'])
+    journal.update('suac', createvm.Journal.UPLOADED)
+    journal.update('sufs', createvm.Journal.FAILED)
+    bld = createvm.Builder(['suac', 'sufs'], journal=journal)
+    rows = bld.report(str(upload_dir))
+    assert [(r['status'], r['size'], r['sha256'] is None) for r in rows] \
+        == [('uploaded', 5, False), ('failed', None, True)]
@@ -0,0 +1,17 @@
+#!/bin/bash
+# Zero-fill free disk space so the exported VMDK can be compacted.
+# Does nothing unless Packer is run with '-var compact=true'.
+
+if test "$COMPACT" != "true" ; then
+  exit 0
+fi
+
+apt-get clean
+rm -rf /var/lib/apt/lists/*
+rm -rf /tmp/* /var/tmp/*
+
+# dd stops with ENOSPC when the disk is full. It is expected.
+dd if=/dev/zero of=/EMPTY bs=1M
+sync
+rm -f /EMPTY
+sync